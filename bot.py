@@ -2,9 +2,12 @@ import os
 import asyncio
 import random
 import asyncpg
-import uuid
 import time
 import json 
+import html
+from collections import deque
+from functools import lru_cache
+from itertools import count, islice
 from datetime import datetime, timedelta, timezone, time as dt_time
 from aiogram import Bot, Dispatcher, types, F
 from aiogram.filters import Command
@@ -30,20 +33,119 @@ RANKS = ["2", "3", "4", "5", "6", "7", "8", "9", "10", "J", "Q", "K", "A"]
 SUITS = ["♠️", "♥️", "♦️", "♣️"]
 DECKS_COUNT = 5
 TOTAL_CARDS = 52 * DECKS_COUNT
+# Одна колода карт-кортежей на весь процесс: шу собирается из тех же объектов
+ALL_CARDS = tuple((r, s) for r in RANKS for s in SUITS)
+# Готовые HTML-токены карт: 52 строки на все рендеры вместо f-строки на каждую карту
+CARD_TOKENS = {c: f"<code>{c[0]}{c[1]}</code>" for c in ALL_CARDS}
+# Экраны стола (лобби и игра) размечены HTML: имена и чат экранируются один раз
+# при сохранении, а не разбираются Markdown-парсером с риском сломать разметку
+TABLE_PARSE_MODE = "HTML"
 RESHUFFLE_THRESHOLD = 60
 BET_OPTIONS = [50, 100, 250]
 MAX_PLAYERS = 3
 TURN_TIMEOUT = 30 
+REFRESH_DELAY = 0.05  # сек. на схлопывание перерисовок стола (см. schedule_refresh)
+CHAT_HISTORY_SIZE = 5  # последних сообщений чата на экране стола
+MAX_BET_DIGITS = 9  # своя ставка должна помещаться в INTEGER столбца balance
 
 # ====== БАЗА ДАННЫХ ======
+# Размер пула можно подстроить под хостинг переменными окружения
+DB_POOL_MIN_SIZE = int(os.getenv("DB_POOL_MIN_SIZE", "5"))
+DB_POOL_MAX_SIZE = int(os.getenv("DB_POOL_MAX_SIZE", "20"))
+DB_STATEMENT_CACHE_SIZE = 256
+DB_MAX_INACTIVE_LIFETIME = 300  # сек. простоя, после которых лишнее соединение закрывается
+DB_COMMAND_TIMEOUT = 5          # сек. на один запрос
+DB_SCHEMA_TIMEOUT = 600         # сек. на схему при старте: CREATE INDEX на большой users идёт долго
+# Лог чата пишется фоном пачками (см. chat_log_writer)
+CHAT_LOG_QUEUE_SIZE = 10000
+CHAT_LOG_BATCH = 100
+CHAT_LOG_FLUSH_DELAY = 0.5  # сек. на накопление пачки после первого сообщения
+CHAT_LOG_COPY_MIN = 20      # с такой пачки выгоднее COPY, чем executemany
+
+# Горячие запросы — одни и те же строки, чтобы asyncpg находил их в кэше
+# подготовленных выражений соединения и не парсил/планировал заново
+# Явный список столбцов вместо *: форма результата не зависит от добавленных
+# позже колонок, и закэшированные выражения не устаревают после ALTER TABLE.
+# max_win мог остаться NULL у старых строк — подставляем 0 сразу в запросе
+USER_COLUMNS = (
+    "user_id, username, balance, games, wins, losses, pushes, blackjacks, "
+    "max_balance, COALESCE(max_win, 0) AS max_win, referrer_id, referral_bonus_paid"
+)
+SQL_SELECT_USER = f"SELECT {USER_COLUMNS} FROM users WHERE user_id = $1"
+# Регистрация одним запросом: вернёт строку и для нового, и для существующего игрока.
+# inserted — была ли строка создана сейчас (xmax = 0 только у только что вставленной)
+SQL_UPSERT_USER = f"""
+    INSERT INTO users (user_id, username, balance, max_balance, max_win)
+    VALUES ($1, $2, 1000, 1000, 0)
+    ON CONFLICT (user_id) DO UPDATE SET username = COALESCE(EXCLUDED.username, users.username)
+    RETURNING {USER_COLUMNS}, (xmax = 0) AS inserted
+"""
+SQL_UPDATE_USERNAME = "UPDATE users SET username = $2 WHERE user_id = $1"
+SQL_SELECT_USERS_BULK = f"SELECT {USER_COLUMNS} FROM users WHERE user_id = ANY($1::bigint[])"
+SQL_UPDATE_USERS_BULK = """
+    UPDATE users AS u SET
+        balance = v.balance, games = v.games, wins = v.wins, losses = v.losses,
+        pushes = v.pushes, blackjacks = v.blackjacks,
+        max_balance = v.max_balance, max_win = v.max_win
+    FROM unnest(
+        $1::bigint[], $2::int[], $3::int[], $4::int[], $5::int[],
+        $6::int[], $7::int[], $8::int[], $9::int[]
+    ) AS v(user_id, balance, games, wins, losses, pushes, blackjacks, max_balance, max_win)
+    WHERE u.user_id = v.user_id
+"""
+SQL_INSERT_GAME_LOG = """
+    INSERT INTO game_logs (table_id, user_id, username, bet, result, win_amount, player_hand, dealer_hand)
+    VALUES ($1, $2, $3, $4, $5, $6, $7, $8)
+"""
+CHAT_LOG_COLUMNS = ("table_id", "user_id", "username", "message")
+SQL_INSERT_CHAT_LOG = """
+    INSERT INTO chat_logs (table_id, user_id, username, message)
+    VALUES ($1, $2, $3, $4)
+"""
+# Начисления — одним запросом с RETURNING: новый баланс без второго SELECT
+SQL_ADD_BALANCE = "UPDATE users SET balance = balance + $2 WHERE user_id = $1 RETURNING username, balance"
+SQL_TAKE_BALANCE = (
+    "UPDATE users SET balance = GREATEST(balance - $2, 0) WHERE user_id = $1 RETURNING username, balance"
+)
+# Ежедневный бонус: строка обновится, только если за этот день бонус ещё не брали
+SQL_CLAIM_DAILY_BONUS = """
+    UPDATE users SET balance = balance + $3, last_bonus_date = $2
+    WHERE user_id = $1 AND last_bonus_date IS DISTINCT FROM $2
+    RETURNING balance
+"""
+
 pool = None
 
+async def _warm_statement_cache(conn):
+    # Чтения с несуществующим id ничего не меняют, но кладут план в кэш соединения
+    try:
+        await conn.fetchrow(SQL_SELECT_USER, 0)
+        await conn.fetch(SQL_SELECT_USERS_BULK, [])
+    except (asyncpg.UndefinedTableError, asyncpg.UndefinedColumnError):
+        # Схема ещё не создана или не обновлена: DDL в init_db идёт уже после
+        # создания пула, а потом _prewarm_pool прогреет соединения заново
+        pass
+
 async def init_db():
     global pool
-    pool = await asyncpg.create_pool(DATABASE_URL)
+    pool = await asyncpg.create_pool(
+        DATABASE_URL,
+        min_size=DB_POOL_MIN_SIZE,
+        max_size=DB_POOL_MAX_SIZE,
+        max_queries=50000,
+        statement_cache_size=DB_STATEMENT_CACHE_SIZE,
+        max_inactive_connection_lifetime=DB_MAX_INACTIVE_LIFETIME,
+        command_timeout=DB_COMMAND_TIMEOUT,
+        # JIT только добавляет планирования на наших однострочных запросах;
+        # server_settings применяется при подключении, без лишнего round-trip
+        server_settings={"jit": "off"},
+        init=_warm_statement_cache,
+    )
     async with pool.acquire() as conn:
-        # Таблица пользователей
+        # Вся схема — один запрос: без параметров asyncpg шлёт его простым
+        # протоколом, где можно несколько команд. IF NOT EXISTS делает его идемпотентным
         await conn.execute("""
+            -- Таблица пользователей
             CREATE TABLE IF NOT EXISTS users (
                 user_id BIGINT PRIMARY KEY,
                 username TEXT, 
@@ -55,23 +157,19 @@ async def init_db():
                 blackjacks INTEGER DEFAULT 0,
                 max_balance INTEGER DEFAULT 1000,
                 max_win INTEGER DEFAULT 0
-            )
-        """)
-        try:
-            await conn.execute("ALTER TABLE users ADD COLUMN IF NOT EXISTS username TEXT")
-        except: pass
+            );
+            ALTER TABLE users ADD COLUMN IF NOT EXISTS username TEXT;
 
-        # --- РЕФЕРАЛЫ: referrer_id и флаг выплаты бонуса после 10 игр ---
-        try:
-            await conn.execute("ALTER TABLE users ADD COLUMN IF NOT EXISTS referrer_id BIGINT")
-        except: pass
-        try:
-            await conn.execute("ALTER TABLE users ADD COLUMN IF NOT EXISTS referral_bonus_paid BOOLEAN DEFAULT FALSE")
-        except: pass
-        # ----------------------------------------------
+            -- Рефералы: referrer_id и флаг выплаты бонуса после 10 игр
+            ALTER TABLE users ADD COLUMN IF NOT EXISTS referrer_id BIGINT;
+            ALTER TABLE users ADD COLUMN IF NOT EXISTS referral_bonus_paid BOOLEAN DEFAULT FALSE;
+            -- Счётчик рефералов в статистике ищет по referrer_id; у большинства игроков он NULL
+            CREATE INDEX IF NOT EXISTS users_referrer_id_idx ON users (referrer_id) WHERE referrer_id IS NOT NULL;
 
-        # Таблица логов игр
-        await conn.execute("""
+            -- Дата последнего ежедневного бонуса
+            ALTER TABLE users ADD COLUMN IF NOT EXISTS last_bonus_date DATE;
+
+            -- Таблица логов игр
             CREATE TABLE IF NOT EXISTS game_logs (
                 id SERIAL PRIMARY KEY,
                 table_id TEXT,
@@ -83,14 +181,10 @@ async def init_db():
                 player_hand TEXT,
                 dealer_hand TEXT,
                 created_at TIMESTAMP DEFAULT NOW()
-            )
-        """)
-        try:
-            await conn.execute("ALTER TABLE game_logs ADD COLUMN IF NOT EXISTS username TEXT")
-        except: pass
-        
-        # Таблица логов чата
-        await conn.execute("""
+            );
+            ALTER TABLE game_logs ADD COLUMN IF NOT EXISTS username TEXT;
+
+            -- Таблица логов чата
             CREATE TABLE IF NOT EXISTS chat_logs (
                 id SERIAL PRIMARY KEY,
                 table_id TEXT,
@@ -98,144 +192,303 @@ async def init_db():
                 username TEXT,
                 message TEXT,
                 created_at TIMESTAMP DEFAULT NOW()
-            )
-        """)
+            );
+        """, timeout=DB_SCHEMA_TIMEOUT)
 
+    await _prewarm_pool()
     print("Database initialized with logs, usernames and referrals")
 
-async def get_player_data(user_id, username=None):
-    async with pool.acquire() as conn:
-        row = await conn.fetchrow("SELECT * FROM users WHERE user_id = $1", user_id)
-        
-        if not row:
-            # Создаем нового пользователя
-            await conn.execute(
-                "INSERT INTO users (user_id, username, balance, max_balance, max_win) VALUES ($1, $2, $3, $3, 0) ON CONFLICT (user_id) DO NOTHING",
-                user_id, username, 1000
-            )
-            return {"balance": 1000, "username": username, "stats": {"games":0, "wins":0, "losses":0, "pushes":0, "blackjacks":0, "max_balance":1000, "max_win":0}}
-        
+async def _prewarm_pool():
+    """
+    Держим сразу все min_size соединений и прогреваем каждое уже после DDL:
+    при первом запуске init-хук срабатывает до создания таблиц.
+    """
+    conns = [await pool.acquire() for _ in range(DB_POOL_MIN_SIZE)]
+    try:
+        await asyncio.gather(*[_warm_statement_cache(c) for c in conns])
+    finally:
+        for c in conns:
+            await pool.release(c)
+
+# Зеркало балансов в памяти: user_id -> balance. Заполняется при чтении из БД,
+# обновляется при расчёте раунда и сбрасывается при любом другом изменении баланса.
+balance_cache = {}
+
+async def get_balance(user_id):
+    """Баланс для проверок «хватает ли на ставку» без похода в БД, если он уже известен."""
+    balance = balance_cache.get(user_id)
+    if balance is None:
+        balance = (await get_player_data(user_id))["balance"]
+    return balance
+
+# Хелперы ниже принимают необязательный conn: если вызывающий код уже держит
+# соединение (например, финализация раунда), повторно в пул не ходим.
+
+async def get_player_data(user_id, username=None, conn=None):
+    if conn is None:
+        async with pool.acquire() as conn:
+            return await get_player_data(user_id, username, conn)
+
+    row = await conn.fetchrow(SQL_SELECT_USER, user_id)
+    
+    if not row:
+        # Создаем нового пользователя и сразу получаем его строку с умолчаниями из схемы
+        row = await conn.fetchrow(SQL_UPSERT_USER, user_id, username)
+    elif username and row['username'] != username:
         # Обновляем юзернейм, если он сменился
-        if username and row['username'] != username:
-             await conn.execute("UPDATE users SET username = $2 WHERE user_id = $1", user_id, username)
-        
-        return {
-            "balance": row["balance"],
-            "username": row["username"], 
-            "stats": {
-                "games": row["games"], "wins": row["wins"], "losses": row["losses"],
-                "pushes": row["pushes"], "blackjacks": row["blackjacks"],
-                "max_balance": row["max_balance"], "max_win": row.get("max_win", 0) or 0
-            }
+        await conn.execute(SQL_UPDATE_USERNAME, user_id, username)
+    
+    balance_cache[user_id] = row["balance"]
+    return player_data_from_row(row)
+
+def player_data_from_row(row):
+    return {
+        "balance": row["balance"],
+        "username": row["username"], 
+        "stats": {
+            "games": row["games"], "wins": row["wins"], "losses": row["losses"],
+            "pushes": row["pushes"], "blackjacks": row["blackjacks"],
+            "max_balance": row["max_balance"], "max_win": row["max_win"]
         }
+    }
 
-async def update_player_stats(user_id, balance, stats):
-    async with pool.acquire() as conn:
-        await conn.execute("""
-            UPDATE users SET 
-                balance = $2, games = $3, wins = $4, losses = $5, 
-                pushes = $6, blackjacks = $7, max_balance = $8, max_win = $9
-            WHERE user_id = $1
-        """, user_id, balance, stats["games"], stats["wins"], stats["losses"], 
-           stats["pushes"], stats["blackjacks"], stats["max_balance"], stats["max_win"])
+async def get_players_bulk(user_ids, conn):
+    """Строки users для нескольких игроков одним запросом: user_id -> Record."""
+    rows = await conn.fetch(SQL_SELECT_USERS_BULK, user_ids)
+    return {row["user_id"]: row for row in rows}
+
+async def update_players_bulk(updates, conn):
+    """
+    Записывает баланс и статистику нескольких игроков одним UPDATE.
+    updates — список (user_id, balance, stats).
+    """
+    if not updates:
+        return
+    await conn.execute(
+        SQL_UPDATE_USERS_BULK,
+        [uid for uid, _, _ in updates],
+        [bal for _, bal, _ in updates],
+        *[[st[key] for _, _, st in updates]
+          for key in ("games", "wins", "losses", "pushes", "blackjacks", "max_balance", "max_win")],
+    )
 
 
 # Реферальный бонус начисляется только после 10 сыгранных игр приглашённого
 REFERRAL_BONUS_GAMES_REQUIRED = 10
 REFERRAL_BONUS_REFERRED = 3000
 REFERRAL_BONUS_REFERRER = 5000
+DAILY_BONUS = 1000
 
 
-async def try_apply_referral_bonus(referred_user_id: int, new_games_count: int):
+async def try_apply_referral_bonus(referred_user_id: int, new_games_count: int, conn=None):
     """
     Если у игрока есть referrer и бонус ещё не выплачен и сыграно >= 10 игр —
     начисляем бонусы обоим и помечаем выплату. Возвращает referrer_id при успехе, иначе None.
     """
     if new_games_count < REFERRAL_BONUS_GAMES_REQUIRED:
         return None
-    async with pool.acquire() as conn:
-        row = await conn.fetchrow(
-            "SELECT referrer_id, referral_bonus_paid FROM users WHERE user_id = $1",
-            referred_user_id,
-        )
-        if not row or row["referrer_id"] is None:
-            return None
-        if row.get("referral_bonus_paid"):
-            return None
-        referrer_id = row["referrer_id"]
-        await conn.execute(
-            "UPDATE users SET balance = balance + $2, referral_bonus_paid = TRUE WHERE user_id = $1",
-            referred_user_id,
-            REFERRAL_BONUS_REFERRED,
-        )
-        await conn.execute(
-            "UPDATE users SET balance = balance + $2 WHERE user_id = $1",
-            referrer_id,
-            REFERRAL_BONUS_REFERRER,
-        )
+    if conn is None:
+        async with pool.acquire() as conn:
+            return await try_apply_referral_bonus(referred_user_id, new_games_count, conn)
+
+    row = await conn.fetchrow(
+        "SELECT referrer_id, referral_bonus_paid FROM users WHERE user_id = $1",
+        referred_user_id,
+    )
+    if not row or row["referrer_id"] is None:
+        return None
+    if row.get("referral_bonus_paid"):
+        return None
+    referrer_id = row["referrer_id"]
+    await conn.execute(
+        "UPDATE users SET balance = balance + $2, referral_bonus_paid = TRUE WHERE user_id = $1",
+        referred_user_id,
+        REFERRAL_BONUS_REFERRED,
+    )
+    await conn.execute(
+        "UPDATE users SET balance = balance + $2 WHERE user_id = $1",
+        referrer_id,
+        REFERRAL_BONUS_REFERRER,
+    )
     return referrer_id
 
-async def log_game(table_id, user_id, username, bet, result, win_amount, p_hand, d_hand):
-    async with pool.acquire() as conn:
-        await conn.execute("""
-            INSERT INTO game_logs (table_id, user_id, username, bet, result, win_amount, player_hand, dealer_hand)
-            VALUES ($1, $2, $3, $4, $5, $6, $7, $8)
-        """, table_id, user_id, username, bet, result, win_amount, str(p_hand), str(d_hand))
+async def log_games_bulk(logs, conn):
+    """
+    Пишет логи рук пачкой: executemany отправляет все строки одним конвейером.
+    logs — список (table_id, user_id, username, bet, result, win_amount, p_hand, d_hand).
+    """
+    if not logs:
+        return
+    await conn.executemany(SQL_INSERT_GAME_LOG, logs)
 
-async def log_chat(table_id, user_id, username, message):
-    async with pool.acquire() as conn:
-        await conn.execute("""
-            INSERT INTO chat_logs (table_id, user_id, username, message)
-            VALUES ($1, $2, $3, $4)
-        """, table_id, user_id, username, message)
+chat_log_queue = asyncio.Queue(maxsize=CHAT_LOG_QUEUE_SIZE)
+
+def log_chat(table_id, user_id, username, message):
+    """Ставит сообщение в очередь на запись; обработчик чата БД не ждёт."""
+    try:
+        chat_log_queue.put_nowait((table_id, user_id, username, message))
+    except asyncio.QueueFull:
+        # БД не успевает: лог чата не критичен, игра важнее
+        pass
+
+async def flush_chat_logs(batch):
+    try:
+        if len(batch) >= CHAT_LOG_COPY_MIN:
+            # Большая пачка — бинарным COPY, без разбора строки на каждое сообщение
+            await pool.copy_records_to_table("chat_logs", records=batch, columns=CHAT_LOG_COLUMNS)
+        else:
+            await pool.executemany(SQL_INSERT_CHAT_LOG, batch)
+    except Exception as e:
+        print(f"Chat log write failed ({len(batch)} rows): {e}")
+
+async def chat_log_writer():
+    """Фоновая задача: забирает лог чата из очереди и пишет пачками одним executemany."""
+    while True:
+        batch = [await chat_log_queue.get()]
+        try:
+            # Даём пачке набраться, а не пишем каждое сообщение отдельно
+            await asyncio.sleep(CHAT_LOG_FLUSH_DELAY)
+        except asyncio.CancelledError:
+            # Бот останавливается: взятое пишем сразу, остаток допишет drain_chat_logs
+            await flush_chat_logs(batch)
+            raise
+        while len(batch) < CHAT_LOG_BATCH and not chat_log_queue.empty():
+            batch.append(chat_log_queue.get_nowait())
+        await flush_chat_logs(batch)
+
+async def drain_chat_logs():
+    """При остановке дописывает то, что осталось в очереди."""
+    batch = []
+    while not chat_log_queue.empty():
+        batch.append(chat_log_queue.get_nowait())
+    if batch:
+        await flush_chat_logs(batch)
 
 # ====== ЛОГИКА ИГРЫ (КЛАССЫ) ======
 
 class CardSystem:
+    """
+    Шу — список фиксированного размера, карты не удаляются: сдаём сверху,
+    сдвигая индекс top. Перетасовка перемешивает тот же список на месте.
+    """
+    __slots__ = ("shoe", "top")
+
     def __init__(self):
-        self.shoe = []
+        self.shoe = list(ALL_CARDS * DECKS_COUNT)
+        self.top = 0
         self.create_shoe()
 
     def create_shoe(self):
-        base_deck = [(r, s) for r in RANKS for s in SUITS]
-        self.shoe = base_deck * DECKS_COUNT
         random.shuffle(self.shoe)
+        self.top = TOTAL_CARDS
 
     def get_card(self):
-        if len(self.shoe) < RESHUFFLE_THRESHOLD:
+        reshuffled = False
+        if self.top < RESHUFFLE_THRESHOLD:
+            self.create_shoe()
+            reshuffled = True
+        self.top -= 1
+        return self.shoe[self.top], reshuffled
+
+    def draw(self, n):
+        """
+        Сразу n карт сверху (для раздачи). Перетасовка — до раздачи, если
+        после неё шу опустится ниже порога, чтобы не мешать шу посреди сдачи.
+        """
+        reshuffled = False
+        if self.top - n < RESHUFFLE_THRESHOLD:
             self.create_shoe()
-            return self.shoe.pop(), True 
-        return self.shoe.pop(), False
+            reshuffled = True
+        cards = self.shoe[self.top - n:self.top]
+        cards.reverse()
+        self.top -= n
+        return cards, reshuffled
     
     def get_visual_bar(self):
-        percent = len(self.shoe) / TOTAL_CARDS
+        percent = self.top / TOTAL_CARDS
         blocks = int(percent * 8)
         bar = "▰" * blocks + "▱" * (8 - blocks)
         return f"{bar} {int(percent * 100)}%"
 
 
+# Очки по рангу считаем один раз, а не разбором строки на каждую карту
+RANK_VALUE = {r: 11 if r == "A" else 10 if r in ("J", "Q", "K") else int(r) for r in RANKS}
+# Очки сразу по карте: один поиск в словаре вместо распаковки кортежа и второго поиска
+CARD_VALUE = {c: RANK_VALUE[c[0]] for c in ALL_CARDS}
+
+class HandValue:
+    """
+    Инкрементальный подсчёт очков руки. Руки только растут (карты добавляются
+    в конец), поэтому при каждом обращении досчитываем лишь новые карты.
+    Если рука заменена другим списком — считаем её заново.
+    """
+    __slots__ = ("hand", "count", "total", "soft_aces")
+
+    def __init__(self):
+        self.hand = None
+        self.count = 0
+        self.total = 0
+        self.soft_aces = 0  # тузы, которые пока считаются за 11
+
+    def of(self, hand):
+        n = len(hand)
+        if hand is self.hand and n == self.count:
+            return self.total  # рука не менялась — обычный случай при рендере
+        if hand is not self.hand or n < self.count:
+            self.hand = hand
+            self.count = 0
+            self.total = 0
+            self.soft_aces = 0
+        for c in hand[self.count:]:
+            v = CARD_VALUE[c]
+            self.total += v
+            if v == 11:
+                self.soft_aces += 1
+            while self.total > 21 and self.soft_aces:
+                self.total -= 10
+                self.soft_aces -= 1
+        self.count = n
+        return self.total
+
+@lru_cache(maxsize=None)
+def settle_hand(hand_val, status, two_cards, dealer_val):
+    """
+    Исход руки против дилера: (result, multiplier), где result — loss / blackjack /
+    win / push, а multiplier — множитель ставки для выплаты. Область значений
+    конечна, поэтому результат кэшируется и общий для рендера и расчёта в БД.
+    """
+    if status == "bust":
+        return "loss", -1
+    if status == "blackjack" or (two_cards and hand_val == 21):
+        return "blackjack", 1.5
+    if dealer_val > 21 or (hand_val <= 21 and hand_val > dealer_val):
+        return "win", 1
+    if hand_val < dealer_val and dealer_val <= 21:
+        return "loss", -1
+    return "push", 0
+
 def can_split_cards(card1, card2):
     """
     Разрешаем сплит, если:
     - ранги полностью совпадают (A+A, 7+7 и т.п.), ИЛИ
     - обе карты имеют ценность 10 (10, J, Q, K в любой комбинации).
     """
-    r1, _ = card1
-    r2, _ = card2
-
-    if r1 == r2:
+    if card1[0] == card2[0]:
         return True
-
-    ten_like = {"10", "J", "Q", "K"}
-    if r1 in ten_like and r2 in ten_like:
-        return True
-
-    return False
+    return CARD_VALUE[card1] == CARD_VALUE[card2] == 10
 
 class TablePlayer:
+    # Игроков много и к их полям обращается каждый рендер — без __dict__
+    __slots__ = (
+        "user_id", "name", "display_name", "original_bet", "hands", "_bets", "_statuses",
+        "current_hand_index", "is_ready", "message_id", "start_balance", "last_action",
+        "_hand_values", "last_sent",
+    )
+
     def __init__(self, user_id, name, bet, start_balance):
         self.user_id = user_id
         self.name = name
+        self.display_name = html.escape(name)  # имя для HTML-экранов стола
         # Базовая ставка для всех рук (до сплита)
         self.original_bet = bet
         # Поддержка нескольких рук после сплита
@@ -247,6 +500,8 @@ class TablePlayer:
         self.message_id = None 
         self.start_balance = start_balance
         self.last_action = None 
+        self._hand_values = {}         # индекс руки -> HandValue
+        self.last_sent = None          # (message_id, текст, клавиатура) последней правки
 
     # Текущая рука (для совместимости со старой логикой)
     @property
@@ -277,16 +532,17 @@ class TablePlayer:
 
     @property
     def value(self):
-        val = sum(10 if c[0] in "JQK" else 11 if c[0] == "A" else int(c[0]) for c in self.hand)
-        aces = sum(1 for c in self.hand if c[0] == "A")
-        while val > 21 and aces:
-            val -= 10
-            aces -= 1
-        return val
+        return self.hand_value(self.current_hand_index)
+
+    def hand_value(self, idx):
+        tracker = self._hand_values.get(idx)
+        if tracker is None:
+            tracker = self._hand_values[idx] = HandValue()
+        return tracker.of(self.hands[idx])
 
     def render_hand(self):
         if not self.hand: return ""
-        return " ".join(f"`{r}{s}`" for r, s in self.hand)
+        return " ".join(CARD_TOKENS[c] for c in self.hand)
 
     # Есть ли хотя бы одна активная рука
     def has_active_hand(self):
@@ -300,45 +556,104 @@ class TablePlayer:
         return None
 
 class GameTable:
+    __slots__ = (
+        "id", "is_public", "owner_id", "players", "_players_by_id", "dealer_hand", "deck",
+        "turn_timer", "_state", "current_player_index", "current_player", "round_id", "shuffle_alert", "last_action_time",
+        "chat_history", "_dealer_value", "broadcast_lock", "refresh_task", "refresh_pending",
+        "finalize_task", "finished_kb", "lobby_kbs", "lobby_header",
+    )
+
     def __init__(self, table_id, is_public=False, owner_id=None):
         self.id = table_id
         self.is_public = is_public
         self.owner_id = owner_id
         self.players = [] 
+        self._players_by_id = {}  # user_id -> TablePlayer; порядок ходов — в self.players
         self.dealer_hand = []
         self.deck = CardSystem()
+        self.turn_timer = None  # задача авто-Stand по TURN_TIMEOUT (см. turn_timeout)
         self.state = "waiting" # waiting, player_turn, dealer_turn, finished
         self.current_player_index = 0
+        self.current_player = None  # тот, чей сейчас ход (players[current_player_index]) или None
+        self.round_id = 0  # номер раздачи: зашит в кнопки хода, чтобы отсекать клики по старым
         self.shuffle_alert = False
         self.last_action_time = time.time()
-        self.chat_history = [] 
+        self.chat_history = deque(maxlen=CHAT_HISTORY_SIZE)
+        self._dealer_value = HandValue()
+        self.broadcast_lock = asyncio.Lock()
+        # Отложенная перерисовка: все изменения за один тик цикла — одна рассылка
+        self.refresh_task = None
+        self.refresh_pending = False
+        # Фоновая запись итогов раунда в БД (см. finish_round)
+        self.finalize_task = None
+        # Клавиатура после раунда не зависит ни от игрока, ни от раунда — собираем один раз
+        self.finished_kb = None
+        self.lobby_kbs = None
+        # Шапка лобби (хост, число мест) меняется только при входе/выходе игроков
+        self.lobby_header = None
+
+    # Смена состояния поддерживает индекс waiting_tables для списка лобби
+    @property
+    def state(self):
+        return self._state
+
+    @state.setter
+    def state(self, value):
+        self._state = value
+        if value != "player_turn":
+            self.cancel_turn_timer()
+        if self.is_public:
+            if value == "waiting":
+                waiting_tables[self.id] = self
+            else:
+                waiting_tables.pop(self.id, None)
 
     def add_player(self, user_id, name, bet, current_balance):
         player = TablePlayer(user_id, name, bet, start_balance=current_balance)
         self.players.append(player)
+        self._players_by_id[user_id] = player
+        user_to_table[user_id] = self.id
+        self.lobby_header = None
         self.update_activity()
         return player
 
     def remove_player(self, user_id):
-        self.players = [p for p in self.players if p.user_id != user_id]
+        player = self._players_by_id.pop(user_id, None)
+        seat = None
+        if player is not None:
+            seat = self.players.index(player)
+            del self.players[seat]
+            if user_to_table.get(user_id) == self.id:
+                del user_to_table[user_id]
         if user_id == self.owner_id:
             if self.players:
                 self.owner_id = self.players[0].user_id
             else:
                 self.owner_id = None 
+        self.lobby_header = None
         self.update_activity()
 
+        # Уход посреди хода игроков (пустой стол вызывающий код просто убирает)
+        if seat is not None and self.state == "player_turn" and self.players:
+            if seat < self.current_player_index:
+                # Место было раньше текущего — индекс сдвигается вместе со списком
+                self.current_player_index -= 1
+            elif player is self.current_player:
+                # Ушёл тот, чей был ход: ход переходит к следующему с того же места,
+                # а если ходить больше некому — раунд доигрывает дилер
+                self.process_turns()
+                if self.state == "finished":
+                    finish_round(self)
+                else:
+                    schedule_refresh(self.id)
+
     def get_player(self, user_id):
-        for p in self.players:
-            if p.user_id == user_id:
-                return p
-        return None
+        return self._players_by_id.get(user_id)
     
     def add_chat_message(self, name, text):
         clean_text = text[:30] 
-        self.chat_history.append(f"{name}: {clean_text}")
-        if len(self.chat_history) > 5: 
-            self.chat_history.pop(0)
+        # История идёт только в HTML-экраны стола — экранируем сразу при записи
+        self.chat_history.append(html.escape(f"{name}: {clean_text}"))
     
     def check_all_ready(self):
         if not self.players: return False
@@ -346,6 +661,7 @@ class GameTable:
 
     def reset_round(self):
         self.state = "waiting"
+        self.current_player = None
         self.dealer_hand = []
         for p in self.players:
             # Сбрасываем все руки и возвращаемся к одной руке
@@ -360,30 +676,30 @@ class GameTable:
 
     def update_activity(self):
         self.last_action_time = time.time()
+        # Таймер хода отсчитывается от последней активности за столом
+        if self.state == "player_turn":
+            self.cancel_turn_timer()
+            self.turn_timer = asyncio.create_task(turn_timeout(self))
+
+    def cancel_turn_timer(self):
+        if self.turn_timer is not None:
+            self.turn_timer.cancel()
+            self.turn_timer = None
 
     def start_game(self):
-        self.dealer_hand = []
-        self.shuffle_alert = False
-        
-        c, s = self.deck.get_card()
-        if s: self.shuffle_alert = True
-        self.dealer_hand.append(c)
-        
-        c, s = self.deck.get_card()
-        if s: self.shuffle_alert = True
-        self.dealer_hand.append(c)
+        self.round_id += 1
+        # Вся раздача — одним срезом шу: дилеру две карты, затем по две каждому игроку
+        cards, self.shuffle_alert = self.deck.draw(2 + 2 * len(self.players))
+        self.dealer_hand = cards[:2]
 
-        for p in self.players:
+        for i, p in enumerate(self.players, 1):
             # На старте раунда всегда одна рука
             p.hands = [[]]
             p._bets = [p.original_bet]
             p._statuses = ["playing"]
             p.current_hand_index = 0
             p.last_action = None
-            c1, s1 = self.deck.get_card()
-            c2, s2 = self.deck.get_card()
-            p.hand = [c1, c2]
-            if s1 or s2: self.shuffle_alert = True
+            p.hand = cards[2 * i:2 * i + 2]
             
             if p.value == 21:
                 p.status = "blackjack"
@@ -401,132 +717,155 @@ class GameTable:
                 first_idx = p.first_active_hand_index()
                 if first_idx is not None:
                     p.current_hand_index = first_idx
+                self.current_player = p
                 return
             # Иначе переходим к следующему игроку
             self.current_player_index += 1
         
+        self.current_player = None
         self.state = "dealer_turn"
         self.play_dealer()
 
     def play_dealer(self):
-        val = self._hand_value(self.dealer_hand)
-        while val < 17:
+        while self.dealer_value < 17:
             c, s = self.deck.get_card()
             if s: self.shuffle_alert = True
             self.dealer_hand.append(c)
-            val = self._hand_value(self.dealer_hand)
         self.state = "finished"
 
+    @property
+    def dealer_value(self):
+        return self._dealer_value.of(self.dealer_hand)
+
     def _hand_value(self, hand):
-        val = sum(10 if c[0] in "JQK" else 11 if c[0] == "A" else int(c[0]) for c in hand)
-        aces = sum(1 for c in hand if c[0] == "A")
+        val = 0
+        aces = 0
+        for c in hand:
+            v = CARD_VALUE[c]
+            val += v
+            if v == 11:
+                aces += 1
         while val > 21 and aces:
             val -= 10
             aces -= 1
         return val
 
 tables = {} 
+# id столов: счётчик уникален в пределах процесса; случайный старт, чтобы кнопки
+# от прошлого запуска бота не попадали в новые столы с тем же номером
+_table_ids = count(random.randrange(1 << 20))
+
+def new_table_id():
+    return f"{next(_table_ids):x}"
+
+# Публичные столы в ожидании игроков: id -> GameTable (без полного обхода tables)
+waiting_tables = {}
+# За каким столом сидит игрок: user_id -> id стола (ведут add_player/remove_player/drop_table)
+user_to_table = {}
+
+def drop_table(table_id):
+    table = tables.pop(table_id, None)
+    if table is not None:
+        table.cancel_turn_timer()
+        for p in table.players:
+            if user_to_table.get(p.user_id) == table_id:
+                del user_to_table[p.user_id]
+    waiting_tables.pop(table_id, None)
 
 def leave_all_tables(user_id, exclude_tid=None):
-    for tid in list(tables.keys()):
-        if tid == exclude_tid: continue
-        table = tables.get(tid)
-        if table and table.get_player(user_id):
-            table.remove_player(user_id)
-            if not table.players:
-                del tables[tid]
-
-# ====== ФОНОВАЯ ЗАДАЧА ======
-async def check_timeouts_loop():
-    while True:
-        await asyncio.sleep(5) 
-        now = time.time()
-        
-        for table in list(tables.values()):
-            if table.state == "player_turn":
-                if now - table.last_action_time > TURN_TIMEOUT:
-                    try:
-                        current_p = table.players[table.current_player_index]
-                        # При таймауте текущая активная рука автоматически встает
-                        current_p.status = "stand"
-                        current_p.last_action = "stand"
-                        
-                        table.process_turns()
-                        
-                        if table.state == "finished":
-                            await finalize_game_db(table)
-                        
-                        await update_table_messages(table.id)
-                        
-                        try: await bot.send_message(current_p.user_id, "⏳ Время хода вышло! Авто-Stand.")
-                        except: pass
-                        
-                    except IndexError:
-                        pass 
+    # Игрок сидит не больше чем за одним столом: каждый вход идёт через leave_all_tables
+    tid = user_to_table.get(user_id)
+    if tid is None or tid == exclude_tid: return
+    table = tables.get(tid)
+    if table and table.get_player(user_id):
+        table.remove_player(user_id)
+        if not table.players:
+            drop_table(tid)
 
-# ====== ВИЗУАЛИЗАЦИЯ ======
+# ====== ТАЙМАУТ ХОДА ======
+async def turn_timeout(table: GameTable):
+    """
+    Таймер хода: запускается из update_activity, пока идёт ход игроков,
+    и отменяется при новой активности или смене состояния стола.
+    """
+    await asyncio.sleep(TURN_TIMEOUT)
+    # Дальше таймер уже не отменяем: process_turns ниже заведёт новый
+    table.turn_timer = None
+    if tables.get(table.id) is not table or table.state != "player_turn":
+        return
+    current_p = table.current_player
+    if current_p is None:
+        return
 
-def render_lobby(table: GameTable):
-    txt = f"🎰 *BLACKJACK LOBBY #{table.id}*\n"
-    txt += f"━━━━━━━━━━━━━━━\n"
+    # При таймауте текущая активная рука автоматически встает
+    current_p.status = "stand"
+    current_p.last_action = "stand"
 
-    owner_name = None
-    for p in table.players:
-        if p.user_id == table.owner_id:
-            owner_name = p.name
-            break
+    table.process_turns()
+
+    if table.state == "finished":
+        finish_round(table)
+    else:
+        schedule_refresh(table.id)
 
-    if owner_name:
-        txt += f"👑 Хост: *{owner_name}*\n"
+    try: await bot.send_message(current_p.user_id, "⏳ Время хода вышло! Авто-Stand.")
+    except: pass
+
+# ====== ВИЗУАЛИЗАЦИЯ ======
 
-    txt += f"👥 Игроки: {len(table.players)}/{MAX_PLAYERS}\n"
-    txt += "━━━━━━━━━━━━━━━\n"
+def _render_lobby_header(table: GameTable):
+    owner = table.get_player(table.owner_id)
+    host_line = f"👑 Хост: <b>{owner.display_name}</b>\n" if owner else ""
+    return (
+        f"🎰 <b>BLACKJACK LOBBY #{table.id}</b>\n"
+        "━━━━━━━━━━━━━━━\n"
+        f"{host_line}"
+        f"👥 Игроки: {len(table.players)}/{MAX_PLAYERS}\n"
+        "━━━━━━━━━━━━━━━\n"
+    )
 
-    for i, p in enumerate(table.players, 1):
+def render_lobby(table: GameTable):
+    if table.lobby_header is None:
+        table.lobby_header = _render_lobby_header(table)
+    parts = [table.lobby_header]
+
+    for p in table.players:
         role = "👑" if p.user_id == table.owner_id else "👤"
         status = "✅ ГОТОВ" if p.is_ready else "⏳ НЕ ГОТОВ"
-        txt += f"{status} {role} *{p.name}* • {p.bet}🪙\n"
+        parts.append(f"{status} {role} <b>{p.display_name}</b> • {p.bet}🪙\n")
 
     if table.chat_history:
-        txt += "\n💬 Чат стола:\n" + "\n".join([f"▫️ {msg}" for msg in table.chat_history])
+        parts.append("\n💬 Чат стола:\n")
+        parts.append("\n".join([f"▫️ {msg}" for msg in table.chat_history]))
     else:
-        txt += "\n✎ Напишите сообщение в этот чат"
+        parts.append("\n✎ Напишите сообщение в этот чат")
 
-    return txt
+    return "".join(parts)
 
 def get_lobby_kb(table: GameTable, user_id):
-    kb = []
-    p = table.get_player(user_id)
-    
-    if not p.is_ready:
-        kb.append([
-            InlineKeyboardButton(text="✅ Я ГОТОВ", callback_data=f"ready_{table.id}"),
-            InlineKeyboardButton(text="💰 Изм. ставку", callback_data=f"chbet_lobby_{table.id}")
-        ])
-    
-    kb.append([InlineKeyboardButton(text="🚪 Выйти", callback_data=f"leave_lobby_{table.id}")])
-    return InlineKeyboardMarkup(inline_keyboard=kb)
-
-async def render_table_for_player(table: GameTable, player: TablePlayer, bot: Bot):
-    if table.state == "finished":
-        d_val = table._hand_value(table.dealer_hand)
-        d_cards = " ".join(f"`{r}{s}`" for r,s in table.dealer_hand)
-        dealer_section = (
-            f"🤵 DEALER\n"
-            f"{d_cards} ➡️ *{d_val}*\n"
-        )
-    else:
-        visible = table.dealer_hand[0]
-        vis_val = table._hand_value([visible])
-        d_cards = f"`{visible[0]}{visible[1]}` `??`"
-        dealer_section = (
-            f"🤵 DEALER\n"
-            f"{d_cards} ➡️ *{vis_val}*\n"
-        )
+    # Вариантов всего два (готов / не готов) — собираем их один раз на стол
+    if table.lobby_kbs is None:
+        leave_row = [InlineKeyboardButton(text="🚪 Выйти", callback_data=f"leave_lobby_{table.id}")]
+        table.lobby_kbs = {
+            False: InlineKeyboardMarkup(inline_keyboard=[
+                [
+                    InlineKeyboardButton(text="✅ Я ГОТОВ", callback_data=f"ready_{table.id}"),
+                    InlineKeyboardButton(text="💰 Изм. ставку", callback_data=f"chbet_lobby_{table.id}")
+                ],
+                leave_row,
+            ]),
+            True: InlineKeyboardMarkup(inline_keyboard=[leave_row]),
+        }
+    return table.lobby_kbs[table.get_player(user_id).is_ready]
 
-    players_section_lines = []
-    for p in table.players:
-        is_me = " (Вы)" if p.user_id == player.user_id else ""
+def render_hand_blocks(table: GameTable):
+    """
+    Блоки рук всех игроков. От зрителя зависит только пометка «(Вы)» в строке
+    с именем, поэтому блок хранится как (user_id, начало строки, остаток).
+    """
+    blocks = []
+    current_idx = table.current_player_index
+    for p_idx, p in enumerate(table.players):
         # Для каждого игрока можем иметь несколько рук (после сплита)
         for idx, hand in enumerate(p.hands):
             # Пропускаем пустые руки на всякий случай
@@ -535,128 +874,144 @@ async def render_table_for_player(table: GameTable, player: TablePlayer, bot: Bo
 
             status_marker = "💤"
             status_text = ""
-            action_trail = ""
-
-            if p.last_action == "hit":
-                action_trail = " (🤏 HIT)"
-            elif p.last_action == "stand":
-                action_trail = " (✋ STAND)"
-            elif p.last_action == "double":
-                action_trail = " (2️⃣ DOUBLE)"
-            elif p.last_action == "split":
-                action_trail = " (✂️ SPLIT)"
 
             # Активная ли это рука
             is_active_hand = (
                 table.state == "player_turn"
-                and table.players[table.current_player_index] == p
+                and p_idx == current_idx
                 and p.current_hand_index == idx
             )
 
             # Статус и значение руки
-            hand_value = table._hand_value(hand)
+            hand_value = p.hand_value(idx)
             status = p._statuses[idx]
             bet = p._bets[idx]
 
             if table.state == "player_turn":
                 if is_active_hand:
                     status_marker = "⏳"
-                    action_trail = " (🤔 ДУМАЕТ...)"
-                elif table.players.index(p) > table.current_player_index:
+                elif p_idx > current_idx:
                     status_marker = "💤"
-                    action_trail = " (💤 ЖДЕТ)"
                 else:
                     status_marker = "✅"
             elif table.state == "finished":
-                d_val = table._hand_value(table.dealer_hand)
+                result, multiplier = settle_hand(hand_value, status, len(hand) == 2, table.dealer_value)
                 if status == "bust":
                     status_marker = "💀"
-                    status_text = "   _❌ ПЕРЕБОР_"
-                elif status == "blackjack" or (len(hand) == 2 and hand_value == 21):
+                    status_text = "   <i>❌ ПЕРЕБОР</i>"
+                elif result == "blackjack":
                     status_marker = "🔥"
-                    status_text = f"   _*🃏 BLACKJACK! (+{int(bet * 1.5)})*_"
-                elif d_val > 21 or (hand_value <= 21 and hand_value > d_val):
+                    status_text = f"   <i><b>🃏 BLACKJACK! (+{int(bet * multiplier)})</b></i>"
+                elif result == "win":
                     status_marker = "🏆"
-                    status_text = f"   _*✅ ПОБЕДА (+{bet})*_"
-                elif hand_value == d_val:
+                    status_text = f"   <i><b>✅ ПОБЕДА (+{bet})</b></i>"
+                elif result == "push":
                     status_marker = "🤝"
-                    status_text = "   _🤝 НИЧЬЯ_"
+                    status_text = "   <i>🤝 НИЧЬЯ</i>"
                 else:
                     status_marker = "❌"
-                    status_text = "   _❌ ПРОИГРЫШ_"
+                    status_text = "   <i>❌ ПРОИГРЫШ</i>"
 
             hand_label = f" (Рука {idx+1})" if len(p.hands) > 1 else ""
-            name_line = f"{status_marker} *{p.name}*{is_me}{hand_label} • {bet}🪙"
-            cards_str = " ".join(f"`{r}{s}`" for r, s in hand)
+            cards_str = " ".join(CARD_TOKENS[c] for c in hand)
             # Для активной руки во время хода показываем “думает” рядом с картами,
             # для завершённой игры — текст результата отдельной строкой.
             if table.state == "player_turn" and is_active_hand:
-                cards_line = f"{cards_str} ➡️ *{hand_value}*   (🤔 ДУМАЕТ...)"
-                extra_line = ""
+                rest = f"{hand_label} • {bet}🪙\n{cards_str} ➡️ <b>{hand_value}</b>   (🤔 ДУМАЕТ...)\n"
+            elif status_text:
+                rest = f"{hand_label} • {bet}🪙\n{cards_str} ➡️ <b>{hand_value}</b>\n{status_text}\n"
             else:
-                cards_line = f"{cards_str} ➡️ *{hand_value}*"
-                extra_line = status_text if status_text else ""
-
-            players_section_lines.append(name_line)
-            players_section_lines.append(cards_line)
-            if extra_line:
-                players_section_lines.append(extra_line)
-            players_section_lines.append("")  # пустая строка-разделитель между руками
-
-    players_section = "\n".join(players_section_lines)
-
-    p_data = await get_player_data(player.user_id)
-    current_balance = p_data['balance']
-    my_p_obj = table.get_player(player.user_id)
-    session_diff = 0
-    if my_p_obj:
-        session_diff = current_balance - my_p_obj.start_balance
-    
-    diff_str = f"+{session_diff}" if session_diff > 0 else f"{session_diff}"
-    
+                rest = f"{hand_label} • {bet}🪙\n{cards_str} ➡️ <b>{hand_value}</b>\n"
+
+            blocks.append((p.user_id, f"{status_marker} <b>{p.display_name}</b>", rest))
+
+    return blocks
+
+def render_table_shared(table: GameTable):
+    """
+    Части экрана стола, одинаковые для всех игроков: дилер, руки, шу и чат.
+    Считаются один раз на перерисовку и передаются в render_table_for_player.
+    """
+    if table.state == "finished":
+        d_val = table.dealer_value
+        d_cards = " ".join(CARD_TOKENS[c] for c in table.dealer_hand)
+        dealer_section = (
+            f"🤵 DEALER\n"
+            f"{d_cards} ➡️ <b>{d_val}</b>\n"
+        )
+    else:
+        visible = table.dealer_hand[0]
+        vis_val = table._hand_value([visible])
+        d_cards = f"{CARD_TOKENS[visible]} <code>??</code>"
+        dealer_section = (
+            f"🤵 DEALER\n"
+            f"{d_cards} ➡️ <b>{vis_val}</b>\n"
+        )
+
     shoe_bar = table.deck.get_visual_bar()
     shuffle_alert = " 🔄 SHUFFLE" if table.shuffle_alert else ""
-    
-    info_section = (
-        f"━━━━━━━━━━━━━━━\n"
-        f"👝 Баланс: *{current_balance}* ({diff_str})\n"
-        f"🃏 Шу: {shoe_bar}{shuffle_alert}"
-    )
 
-    chat_section = "\n━━━━━━━━━━━━━━━\n"
+    chat_parts = ["\n━━━━━━━━━━━━━━━\n"]
     if table.chat_history:
-        chat_section += "💬 Чат стола (последние сообщения):\n"
-        chat_section += "\n".join([f"▫️ {msg}" for msg in table.chat_history]) + "\n"
-    chat_section += "✎ Напишите сообщение в этот чат"
+        chat_parts.append("💬 Чат стола (последние сообщения):\n")
+        chat_parts.extend(f"▫️ {msg}\n" for msg in table.chat_history)
+    chat_parts.append("✎ Напишите сообщение в этот чат")
+
+    return {
+        "header": (
+            f"🎰 <b>TABLE #{table.id}</b>\n"
+            f"━━━━━━━━━━━━━━━\n"
+            f"{dealer_section}"
+            f"━━━━━━━━━━━━━━━\n"
+        ),
+        "hand_blocks": render_hand_blocks(table),
+        # Всё, что идёт после строки баланса, — одной готовой строкой
+        "footer": f"🃏 Шу: {shoe_bar}{shuffle_alert}\n" + "".join(chat_parts),
+    }
+
+async def render_table_for_player(table: GameTable, player: TablePlayer, bot: Bot, shared=None):
+    if shared is None:
+        shared = render_table_shared(table)
+
+    me = player.user_id
+    players_section = "\n".join(
+        f"{head} (Вы){rest}" if uid == me else f"{head}{rest}"
+        for uid, head, rest in shared["hand_blocks"]
+    )
 
-    final_text = (
-        f"🎰 *TABLE #{table.id}*\n"
-        f"━━━━━━━━━━━━━━━\n"
-        f"{dealer_section}"
-        f"━━━━━━━━━━━━━━━\n"
+    # Баланс берём из зеркала в памяти: finalize_game_db обновляет его после раунда
+    current_balance = await get_balance(me)
+    session_diff = current_balance - player.start_balance
+    diff_str = f"+{session_diff}" if session_diff > 0 else f"{session_diff}"
+
+    # Для конкретного игрока меняются только руки и строка баланса
+    return (
+        f"{shared['header']}"
         f"{players_section}\n"
-        f"{info_section}\n"
-        f"{chat_section}"
+        f"━━━━━━━━━━━━━━━\n"
+        f"👝 Баланс: <b>{current_balance}</b> ({diff_str})\n"
+        f"{shared['footer']}"
     )
-    
-    return final_text
+
+def _build_finished_kb(table: GameTable):
+    if not table.is_public:
+        return InlineKeyboardMarkup(inline_keyboard=[
+            [InlineKeyboardButton(text="🔁 Играть еще", callback_data=f"replay_{table.id}")],
+            [InlineKeyboardButton(text="💰 Изм. ставку", callback_data="play_solo")],
+            [InlineKeyboardButton(text="🚪 Меню", callback_data="menu")]
+        ])
+    return InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text="✅ Продолжить", callback_data=f"rematch_{table.id}")],
+        [InlineKeyboardButton(text="🚪 Выйти", callback_data=f"leave_lobby_{table.id}")]
+    ])
 
 def get_game_kb(table: GameTable, player: TablePlayer):
     if table.state == "finished":
-        if not table.is_public:
-            return InlineKeyboardMarkup(inline_keyboard=[
-                [InlineKeyboardButton(text="🔁 Играть еще", callback_data=f"replay_{table.id}")],
-                [InlineKeyboardButton(text="💰 Изм. ставку", callback_data="play_solo")],
-                [InlineKeyboardButton(text="🚪 Меню", callback_data="menu")]
-            ])
-        else:
-            return InlineKeyboardMarkup(inline_keyboard=[
-                [InlineKeyboardButton(text="✅ Продолжить", callback_data=f"rematch_{table.id}")],
-                [InlineKeyboardButton(text="🚪 Выйти", callback_data=f"leave_lobby_{table.id}")]
-            ])
+        if table.finished_kb is None:
+            table.finished_kb = _build_finished_kb(table)
+        return table.finished_kb
 
-    current_p = table.players[table.current_player_index]
-    if current_p != player:
+    if table.current_player is not player:
         return None 
 
     kb = []
@@ -669,10 +1024,10 @@ def get_game_kb(table: GameTable, player: TablePlayer):
         and len(player.hand) == 2
         and can_split_cards(player.hand[0], player.hand[1])
     ):
-        top_row.append(InlineKeyboardButton(text="✂️ SPLIT", callback_data=f"split_{table.id}"))
+        top_row.append(InlineKeyboardButton(text="✂️ SPLIT", callback_data=f"split_{table.id}_{table.round_id}"))
 
     if len(player.hand) == 2:
-        top_row.append(InlineKeyboardButton(text="2️⃣ x2", callback_data=f"double_{table.id}"))
+        top_row.append(InlineKeyboardButton(text="2️⃣ x2", callback_data=f"double_{table.id}_{table.round_id}"))
 
     if top_row:
         kb.append(top_row)
@@ -680,127 +1035,257 @@ def get_game_kb(table: GameTable, player: TablePlayer):
     # Вторая строка: Hit / Stand
     kb.append(
         [
-            InlineKeyboardButton(text="🖐 HIT", callback_data=f"hit_{table.id}"),
-            InlineKeyboardButton(text="✋ STAND", callback_data=f"stand_{table.id}"),
+            InlineKeyboardButton(text="🖐 HIT", callback_data=f"hit_{table.id}_{table.round_id}"),
+            InlineKeyboardButton(text="✋ STAND", callback_data=f"stand_{table.id}_{table.round_id}"),
         ]
     )
     
     return InlineKeyboardMarkup(inline_keyboard=kb)
 
 
+def _kb_signature(kb):
+    if kb is None:
+        return None
+    return tuple(tuple((b.text, b.callback_data) for b in row) for row in kb.inline_keyboard)
+
+def mark_sent(p, msg, txt, kb):
+    """
+    Запоминает экран стола, отправленный игроку напрямую (не через
+    _edit_player_messages), чтобы следующая перерисовка не слала то же самое.
+    """
+    p.message_id = msg.message_id
+    p.last_sent = (msg.message_id, txt, _kb_signature(kb))
+
+async def _edit_player_messages(edits):
+    """
+    Параллельно редактирует сообщения игроков: edits — список (player, text, kb).
+    Если игроку уже отправлено ровно это, запрос в Telegram не делаем вовсе,
+    а если поменялись только кнопки — правим одну клавиатуру.
+    TelegramBadRequest («message is not modified» и т.п.) глушим, как и раньше;
+    прочие ошибки (бот заблокирован, флуд-лимит, сеть) пишем в лог и идём дальше —
+    рассылка идёт из фоновой задачи, и один игрок не должен ломать её остальным.
+    """
+    pending = []
+    for p, txt, kb in edits:
+        sent = (p.message_id, txt, _kb_signature(kb))
+        if p.last_sent != sent:
+            pending.append((p, txt, kb, sent))
+
+    requests = []
+    for p, txt, kb, sent in pending:
+        if p.last_sent is not None and p.last_sent[:2] == sent[:2]:
+            requests.append(bot.edit_message_reply_markup(chat_id=p.user_id, message_id=p.message_id, reply_markup=kb))
+        else:
+            requests.append(bot.edit_message_text(txt, chat_id=p.user_id, message_id=p.message_id, reply_markup=kb, parse_mode=TABLE_PARSE_MODE))
+
+    results = await asyncio.gather(*requests, return_exceptions=True)
+    for (p, _, _, sent), res in zip(pending, results):
+        if isinstance(res, Exception):
+            if not isinstance(res, TelegramBadRequest):
+                print(f"Table message edit failed for {p.user_id}: {res!r}")
+        else:
+            p.last_sent = sent
+
 async def update_table_messages(table_id):
     table = tables.get(table_id)
     if not table: return
 
     if not table.players:
-        del tables[table_id]
+        drop_table(table_id)
         return
 
-    if table.state == "waiting":
-        txt = render_lobby(table)
-        for p in table.players:
+    # Одна рассылка на стол за раз, чтобы правки от быстрых нажатий не перемешивались
+    async with table.broadcast_lock:
+        if table.state == "waiting":
+            txt = render_lobby(table)
+            await _edit_player_messages([
+                (p, txt, get_lobby_kb(table, p.user_id))
+                for p in table.players if p.message_id
+            ])
+            return
+
+        shared = render_table_shared(table)
+        edits = []
+        # Снимок: пока ждём баланс в цикле, состав стола может поменяться
+        for p in list(table.players):
             if p.message_id:
-                kb = get_lobby_kb(table, p.user_id)
-                try:
-                    await bot.edit_message_text(txt, chat_id=p.user_id, message_id=p.message_id, reply_markup=kb, parse_mode="Markdown")
-                except TelegramBadRequest: pass
-        return
+                txt = await render_table_for_player(table, p, bot, shared)
+                edits.append((p, txt, get_game_kb(table, p)))
 
-    for p in table.players:
-        if p.message_id:
-            txt = await render_table_for_player(table, p, bot)
-            kb = get_game_kb(table, p)
-            try:
-                await bot.edit_message_text(txt, chat_id=p.user_id, message_id=p.message_id, reply_markup=kb, parse_mode="Markdown")
-            except TelegramBadRequest: pass
-
-async def finalize_game_db(table: GameTable):
-    d_val = table._hand_value(table.dealer_hand)
-    
-    for p in table.players:
-        data = await get_player_data(p.user_id)
-        p_username = data.get("username", "Unknown")
-        stats = data["stats"]
-        bal = data["balance"]
+        await _edit_player_messages(edits)
 
-        total_win_amount = 0
+async def _refresh_table_loop(table_id):
+    # Короткое окно: нажатия нескольких игроков подряд уходят одной рассылкой
+    await asyncio.sleep(REFRESH_DELAY)
+    while True:
+        table = tables.get(table_id)
+        if not table or not table.refresh_pending:
+            return
+        table.refresh_pending = False
+        await wait_settled(table)
+        try:
+            await update_table_messages(table_id)
+        except Exception as e:
+            # Задачу никто не ждёт: без этого ошибка оборвала бы цикл, и
+            # перерисовки, запрошенные во время рассылки, потерялись бы
+            print(f"Table refresh failed for table {table_id}: {e!r}")
 
-        # Обрабатываем каждую руку отдельно (для сплита)
-        for idx, hand in enumerate(p.hands):
-            if not hand:
-                continue
+def schedule_refresh(table_id):
+    """
+    Планирует перерисовку стола. Повторные вызовы, пока перерисовка ещё не
+    выполнена, схлопываются в одну — рисуется только последнее состояние.
+    """
+    table = tables.get(table_id)
+    if not table:
+        return
+    table.refresh_pending = True
+    if table.refresh_task is None or table.refresh_task.done():
+        table.refresh_task = asyncio.create_task(_refresh_table_loop(table_id))
 
-            status = p._statuses[idx]
-            bet = p._bets[idx]
+async def _finalize_then_refresh(table: GameTable, players):
+    try:
+        await finalize_game_db(table, players=players)
+    except Exception as e:
+        # Задачу никто не ждёт — без этого ошибка БД пропала бы молча
+        print(f"Round settlement failed for table {table.id}: {e}")
+    finally:
+        # Даже при ошибке стол не должен застыть на игровом экране
+        schedule_refresh(table.id)
 
-            result_type = "loss"
-            win_amount = 0
-
-            hand_val = table._hand_value(hand)
-
-            if status == "bust":
-                win_amount = -bet
-                stats["losses"] += 1
-                result_type = "loss"
-            elif status == "blackjack" or (len(hand) == 2 and hand_val == 21):
-                win_amount = int(bet * 1.5)
-                stats["wins"] += 1
-                stats["blackjacks"] += 1
-                result_type = "blackjack"
-            elif d_val > 21 or (hand_val <= 21 and hand_val > d_val):
-                win_amount = bet
-                stats["wins"] += 1
-                result_type = "win"
-            elif hand_val < d_val and d_val <= 21:
-                win_amount = -bet
-                stats["losses"] += 1
-                result_type = "loss"
-            else:
-                win_amount = 0
-                stats["pushes"] += 1
-                result_type = "push"
-
-            total_win_amount += win_amount
-
-            # Лог отдельной руки
-            await log_game(
-                table.id,
-                p.user_id,
-                p_username,
-                bet,
-                result_type,
-                win_amount,
-                hand,
-                table.dealer_hand,
-            )
+def finish_round(table: GameTable):
+    """
+    Запускает расчёт раунда в фоне, чтобы обработчик сразу ответил Telegram.
+    Стол перерисуется, когда балансы уже записаны.
+    """
+    # Состав стола фиксируем сейчас: ушедший до записи итогов всё равно рассчитывается
+    table.finalize_task = asyncio.create_task(_finalize_then_refresh(table, list(table.players)))
 
-        new_bal = bal + total_win_amount
-        stats["games"] += 1
-        stats["max_balance"] = max(stats["max_balance"], new_bal)
-        if total_win_amount > 0:
-            stats["max_win"] = max(stats["max_win"], total_win_amount)
+def advance_turn(table: GameTable, player):
+    """Рука доиграна: следующая рука игрока или следующий игрок, затем одна перерисовка."""
+    next_idx = player.first_active_hand_index()
+    if next_idx is not None:
+        player.current_hand_index = next_idx
+    else:
+        table.process_turns()
+    if table.state == "finished":
+        finish_round(table)
+    else:
+        schedule_refresh(table.id)
+
+async def wait_settled(table: GameTable):
+    # Всё, что читает балансы или начинает новый раунд, ждёт записи итогов
+    if table.finalize_task is not None and not table.finalize_task.done():
+        await table.finalize_task
+
+async def finalize_game_db(table: GameTable, conn=None, players=None):
+    # Снимок игроков до первого await: leave_all_tables может убрать место из
+    # table.players, пока ждём БД, а руки ушедшего всё равно надо рассчитать
+    if players is None:
+        players = list(table.players)
+    if conn is None:
+        async with pool.acquire() as conn:
+            return await finalize_game_db(table, conn, players)
+
+    d_val = table.dealer_value
+    # Рука дилера одна на весь раунд — строку для логов собираем один раз
+    d_hand_log = str(table.dealer_hand)
+    updates = []
+    game_logs = []
+    referral_candidates = []
+    referral_paid = []
+
+    # Весь расчёт раунда — одна транзакция: одно чтение и одна запись на всех игроков
+    async with conn.transaction():
+        rows = await get_players_bulk([p.user_id for p in players], conn)
+
+        for p in players:
+            row = rows.get(p.user_id)
+            if row is not None:
+                data = player_data_from_row(row)
+            else:
+                data = await get_player_data(p.user_id, conn=conn)
+            p_username = data.get("username", "Unknown")
+            stats = data["stats"]
+            bal = data["balance"]
+
+            total_win_amount = 0
+
+            # Обрабатываем каждую руку отдельно (для сплита)
+            for idx, hand in enumerate(p.hands):
+                if not hand:
+                    continue
+
+                status = p._statuses[idx]
+                bet = p._bets[idx]
+
+                result_type, multiplier = settle_hand(p.hand_value(idx), status, len(hand) == 2, d_val)
+                win_amount = int(bet * multiplier)
+                if result_type == "blackjack":
+                    stats["wins"] += 1
+                    stats["blackjacks"] += 1
+                elif result_type == "win":
+                    stats["wins"] += 1
+                elif result_type == "loss":
+                    stats["losses"] += 1
+                else:
+                    stats["pushes"] += 1
 
-        await update_player_stats(p.user_id, new_bal, stats)
+                total_win_amount += win_amount
 
-        # Реферальный бонус: начисляем обоим после 10-й игры приглашённого
-        referrer_id = await try_apply_referral_bonus(p.user_id, stats["games"])
-        if referrer_id is not None:
-            try:
-                await bot.send_message(
+                # Лог отдельной руки — запишем вместе с остальными
+                game_logs.append((
+                    table.id,
                     p.user_id,
-                    f"🎉 *Реферальный бонус!*\nВы сыграли {REFERRAL_BONUS_GAMES_REQUIRED} партий — вам начислено *+{REFERRAL_BONUS_REFERRED}* фишек! 🪙",
-                    parse_mode="Markdown",
-                )
-            except Exception:
-                pass
-            try:
-                await bot.send_message(
-                    referrer_id,
-                    f"🎉 *Ваш реферал сыграл {REFERRAL_BONUS_GAMES_REQUIRED} партий!*\nВам начислено *+{REFERRAL_BONUS_REFERRER}* фишек 🪙",
-                    parse_mode="Markdown",
-                )
-            except Exception:
-                pass
+                    p_username,
+                    bet,
+                    result_type,
+                    win_amount,
+                    str(hand),
+                    d_hand_log,
+                ))
+
+            new_bal = bal + total_win_amount
+            stats["games"] += 1
+            stats["max_balance"] = max(stats["max_balance"], new_bal)
+            if total_win_amount > 0:
+                stats["max_win"] = max(stats["max_win"], total_win_amount)
+
+            updates.append((p.user_id, new_bal, stats))
+            # В реферальную проверку идут только те, кому бонус ещё может полагаться
+            if row is None or (row["referrer_id"] is not None and not row["referral_bonus_paid"]):
+                referral_candidates.append((p.user_id, stats["games"]))
+
+        await log_games_bulk(game_logs, conn)
+        await update_players_bulk(updates, conn)
+
+        # Бонусы начисляем после записи балансов, чтобы UPDATE их не перезаписал
+        for user_id, games in referral_candidates:
+            referrer_id = await try_apply_referral_bonus(user_id, games, conn=conn)
+            if referrer_id is not None:
+                referral_paid.append((user_id, referrer_id))
+
+    for user_id, new_bal, _ in updates:
+        balance_cache[user_id] = new_bal
+    for user_id, referrer_id in referral_paid:
+        balance_cache.pop(user_id, None)
+        balance_cache.pop(referrer_id, None)
+
+    # Реферальный бонус: уведомляем обоих после 10-й игры приглашённого.
+    # Сообщения независимы — отправляем разом, ошибки доставки игнорируем
+    notifications = []
+    for user_id, referrer_id in referral_paid:
+        notifications.append(bot.send_message(
+            user_id,
+            f"🎉 *Реферальный бонус!*\nВы сыграли {REFERRAL_BONUS_GAMES_REQUIRED} партий — вам начислено *+{REFERRAL_BONUS_REFERRED}* фишек! 🪙",
+            parse_mode="Markdown",
+        ))
+        notifications.append(bot.send_message(
+            referrer_id,
+            f"🎉 *Ваш реферал сыграл {REFERRAL_BONUS_GAMES_REQUIRED} партий!*\nВам начислено *+{REFERRAL_BONUS_REFERRER}* фишек 🪙",
+            parse_mode="Markdown",
+        ))
+    if notifications:
+        await asyncio.gather(*notifications, return_exceptions=True)
 
 # ====== ХЕНДЛЕРЫ ======
 # -- АДМИНКА: ВЫДАЧА ФИШЕК --
@@ -820,45 +1305,42 @@ async def cmd_admin_add(message: types.Message):
         target_id = int(args[1])
         amount = int(args[2])
 
-        async with pool.acquire() as conn:
-            # Проверяем, есть ли такой игрок
-            user = await conn.fetchrow("SELECT username, balance FROM users WHERE user_id = $1", target_id)
-            if not user:
-                await message.answer("❌ Игрок с таким ID не найден в базе.")
-                return
-            
-            # Меняем баланс
-            await conn.execute("UPDATE users SET balance = balance + $2 WHERE user_id = $1", target_id, amount)
-            new_bal = user['balance'] + amount
-            
-            # Лог для админа
-            username = user['username'] or "Без ника"
-            action = "Выдано" if amount > 0 else "Снято"
-            await message.answer(
-                f"✅ *Успешно!*\n"
-                f"👤 Игрок: {username} (`{target_id}`)\n"
-                f"💰 {action}: {abs(amount)}\n"
-                f"🏦 Стало: {new_bal}",
-                parse_mode="Markdown"
-            )
+        # Меняем баланс; пустой ответ — такого игрока нет
+        user = await pool.fetchrow(SQL_ADD_BALANCE, target_id, amount)
+        if not user:
+            await message.answer("❌ Игрок с таким ID не найден в базе.")
+            return
+        new_bal = user['balance']
+        balance_cache[target_id] = new_bal
+        
+        # Лог для админа
+        username = user['username'] or "Без ника"
+        action = "Выдано" if amount > 0 else "Снято"
+        await message.answer(
+            f"✅ *Успешно!*\n"
+            f"👤 Игрок: {username} (`{target_id}`)\n"
+            f"💰 {action}: {abs(amount)}\n"
+            f"🏦 Стало: {new_bal}",
+            parse_mode="Markdown"
+        )
+        
+        # Уведомление игроку
+        try:
+            msg_text = ""
+            if amount > 0:
+                msg_text = (
+                    f"🎁 *Администратор начислил вам {amount} фишек!*\n"
+                    f"💼 Ваш новый баланс: *{new_bal}* 🪙"
+                )
+            else:
+                msg_text = (
+                    f"📉 *Администратор списал у вас {abs(amount)} фишек.*\n"
+                    f"💼 Ваш новый баланс: *{new_bal}* 🪙"
+                )
             
-            # Уведомление игроку
-            try:
-                msg_text = ""
-                if amount > 0:
-                    msg_text = (
-                        f"🎁 *Администратор начислил вам {amount} фишек!*\n"
-                        f"💼 Ваш новый баланс: *{new_bal}* 🪙"
-                    )
-                else:
-                    msg_text = (
-                        f"📉 *Администратор списал у вас {abs(amount)} фишек.*\n"
-                        f"💼 Ваш новый баланс: *{new_bal}* 🪙"
-                    )
-                
-                await bot.send_message(target_id, msg_text, parse_mode="Markdown")
-            except:
-                await message.answer("⚠ Игрок заблокировал бота, уведомление не доставлено.")
+            await bot.send_message(target_id, msg_text, parse_mode="Markdown")
+        except:
+            await message.answer("⚠ Игрок заблокировал бота, уведомление не доставлено.")
 
     except ValueError:
         await message.answer("❌ Ошибка: ID и Сумма должны быть числами.")
@@ -884,38 +1366,32 @@ async def cmd_admin_delete(message: types.Message):
             await message.answer("⚠ Сумма должна быть положительным числом.")
             return
 
-        async with pool.acquire() as conn:
-            user = await conn.fetchrow("SELECT username, balance FROM users WHERE user_id = $1", target_id)
-            if not user:
-                await message.answer("❌ Игрок с таким ID не найден в базе.")
-                return
+        # Списываем фишки, не даём балансу уйти в минус
+        user = await pool.fetchrow(SQL_TAKE_BALANCE, target_id, amount)
+        if not user:
+            await message.answer("❌ Игрок с таким ID не найден в базе.")
+            return
+        new_bal = user["balance"]
+        balance_cache[target_id] = new_bal
+
+        username = user["username"] or "Без ника"
+        await message.answer(
+            f"✅ *Списание успешно!*\n"
+            f"👤 Игрок: {username} (`{target_id}`)\n"
+            f"📉 Списано: {amount}\n"
+            f"🏦 Остаток: {new_bal}",
+            parse_mode="Markdown",
+        )
 
-            # Списываем фишки, не даём балансу уйти в минус
-            await conn.execute(
-                "UPDATE users SET balance = GREATEST(balance - $2, 0) WHERE user_id = $1",
+        # Уведомляем игрока
+        try:
+            await bot.send_message(
                 target_id,
-                amount,
-            )
-            new_bal = await conn.fetchval("SELECT balance FROM users WHERE user_id = $1", target_id)
-
-            username = user["username"] or "Без ника"
-            await message.answer(
-                f"✅ *Списание успешно!*\n"
-                f"👤 Игрок: {username} (`{target_id}`)\n"
-                f"📉 Списано: {amount}\n"
-                f"🏦 Остаток: {new_bal}",
+                f"📉 *Администратор списал у вас {amount} фишек.*\nТекущий баланс: *{new_bal}* 🪙",
                 parse_mode="Markdown",
             )
-
-            # Уведомляем игрока
-            try:
-                await bot.send_message(
-                    target_id,
-                    f"📉 *Администратор списал у вас {amount} фишек.*\nТекущий баланс: *{new_bal}* 🪙",
-                    parse_mode="Markdown",
-                )
-            except:
-                await message.answer("⚠ Игрок заблокировал бота, уведомление не доставлено.")
+        except:
+            await message.answer("⚠ Игрок заблокировал бота, уведомление не доставлено.")
 
     except ValueError:
         await message.answer("❌ Ошибка: ID и Сумма должны быть числами.")
@@ -943,22 +1419,9 @@ async def cmd_start(message: types.Message, state: FSMContext):
             pass
 
     async with pool.acquire() as conn:
-        # 1. Регистрируем или получаем пользователя
-        row = await conn.fetchrow("SELECT * FROM users WHERE user_id = $1", user_id)
-        is_new_player = False
-        
-        if not row:
-            # Создаем нового
-            await conn.execute(
-                "INSERT INTO users (user_id, username, balance, max_balance, max_win) VALUES ($1, $2, 1000, 1000, 0)",
-                user_id, username
-            )
-            is_new_player = True
-            row = await conn.fetchrow("SELECT * FROM users WHERE user_id = $1", user_id)
-        
-        # Обновляем юзернейм
-        if username and row['username'] != username:
-            await conn.execute("UPDATE users SET username = $2 WHERE user_id = $1", user_id, username)
+        # 1. Регистрируем или получаем пользователя (заодно обновляем юзернейм)
+        row = await conn.fetchrow(SQL_UPSERT_USER, user_id, username)
+        is_new_player = row["inserted"]
 
         # 2. РЕФЕРАЛКА: только записываем пригласившего; бонусы — после 10 игр приглашённого
         if is_new_player and referrer_candidate and referrer_candidate != user_id:
@@ -972,9 +1435,10 @@ async def cmd_start(message: types.Message, state: FSMContext):
                     parse_mode="Markdown",
                 )
 
-        # 3. ПОЛУЧАЕМ ДАННЫЕ И ОТПРАВЛЯЕМ МЕНЮ (ВСЕГДА!)
-        # Важно заново запросить данные из базы, так как баланс мог измениться после бонуса
-        data = await get_player_data(user_id, username)
+        # 3. ОТПРАВЛЯЕМ МЕНЮ (ВСЕГДА!)
+        # Бонусы при старте не начисляются, так что строка из шага 1 актуальна
+        balance_cache[user_id] = row["balance"]
+        data = player_data_from_row(row)
         s = data['stats']
         name = f"@{data['username']}" if data['username'] else message.from_user.first_name
 
@@ -989,22 +1453,50 @@ async def cmd_start(message: types.Message, state: FSMContext):
         f"🎲 _Столы открыты. Делайте ваши ставки._"
     )
 
-    await message.answer(text, parse_mode="Markdown", reply_markup=main_menu_kb())
-
-def main_menu_kb():
-    return InlineKeyboardMarkup(inline_keyboard=[
-        [
-            InlineKeyboardButton(text="👤 Одиночная игра", callback_data="play_solo"),
-            InlineKeyboardButton(text="👥 Онлайн столы", callback_data="play_multi"),
-        ],
-        [
-            InlineKeyboardButton(text="📊 Статистика", callback_data="stats"),
-            InlineKeyboardButton(text="🎁 Бесплатные фишки", callback_data="free_chips"),
-        ],
-        [InlineKeyboardButton(text="🤝 Реферальная программа", callback_data="ref_system")],
-    ])
+    await message.answer(text, parse_mode="Markdown", reply_markup=MAIN_MENU_KB)
+
+# Главное меню статично — собираем разметку один раз при импорте
+MAIN_MENU_KB = InlineKeyboardMarkup(inline_keyboard=[
+    [
+        InlineKeyboardButton(text="👤 Одиночная игра", callback_data="play_solo"),
+        InlineKeyboardButton(text="👥 Онлайн столы", callback_data="play_multi"),
+    ],
+    [
+        InlineKeyboardButton(text="📊 Статистика", callback_data="stats"),
+        InlineKeyboardButton(text="🎁 Бесплатные фишки", callback_data="free_chips"),
+    ],
+    [InlineKeyboardButton(text="🤝 Реферальная программа", callback_data="ref_system")],
+])
+
+# Остальные статичные меню — тоже константы
+SOLO_BET_KB = InlineKeyboardMarkup(inline_keyboard=[
+    [InlineKeyboardButton(text=f"💰 {b}", callback_data=f"start_solo_{b}") for b in BET_OPTIONS],
+    [InlineKeyboardButton(text="✍️ Своя ставка", callback_data="custom_bet")],
+    [InlineKeyboardButton(text="🔙 В главное меню", callback_data="menu")],
+])
+CREATE_BET_KB = InlineKeyboardMarkup(inline_keyboard=[
+    [InlineKeyboardButton(text=f"💰 {b}", callback_data=f"new_multi_{b}") for b in BET_OPTIONS],
+    [InlineKeyboardButton(text="✍️ Своя ставка", callback_data="multi_custom_create")],
+    [InlineKeyboardButton(text="🔙 Назад в лобби", callback_data="play_multi")],
+])
+REF_BACK_KB = InlineKeyboardMarkup(inline_keyboard=[[InlineKeyboardButton(text="🔙 В меню", callback_data="menu")]])
+STATS_BACK_KB = InlineKeyboardMarkup(inline_keyboard=[[InlineKeyboardButton(text="🔙 Меню", callback_data="menu")]])
+TABLE_GONE_KB = InlineKeyboardMarkup(inline_keyboard=[[InlineKeyboardButton(text="Ок", callback_data="play_multi")]])
+
+# -- ХОДЫ В ИГРЕ --
+# Самые частые нажатия: один обработчик, зарегистрированный первым среди callback'ов,
+# разбирает callback_data один раз и вызывает действие по словарю GAME_ACTIONS
+@dp.callback_query(F.data.func(lambda data: data.partition("_")[0] in GAME_ACTIONS))
+async def cb_game_action(call: CallbackQuery):
+    action, _, args = call.data.partition("_")
+    tid, _, round_id = args.partition("_")
+    table = tables.get(tid)
+    # Кнопка из уже сыгранной раздачи — отвечаем сразу, стол не трогаем
+    if table is not None and round_id != str(table.round_id):
+        return await call.answer("Эта раздача уже закончилась.")
+    await GAME_ACTIONS[action](call, tid)
 
-@dp.callback_query(lambda c: c.data == "menu")
+@dp.callback_query(F.data == "menu")
 async def cb_menu(call: CallbackQuery):
     data = await get_player_data(call.from_user.id, call.from_user.username)
     s = data['stats']
@@ -1022,13 +1514,13 @@ async def cb_menu(call: CallbackQuery):
     )
     # Используем edit_text, чтобы не спамить новыми сообщениями при нажатии "Назад"
     try:
-        await call.message.edit_text(text, parse_mode="Markdown", reply_markup=main_menu_kb())
+        await call.message.edit_text(text, parse_mode="Markdown", reply_markup=MAIN_MENU_KB)
     except TelegramBadRequest:
         # Если текст не изменился (например, юзер дважды нажал), просто игнорируем ошибку
         pass
 
 # --- ОБРАБОТЧИК КНОПКИ РЕФЕРАЛКИ (ЕГО НЕ БЫЛО) ---
-@dp.callback_query(lambda c: c.data == "ref_system")
+@dp.callback_query(F.data == "ref_system")
 async def cb_ref_system(call: CallbackQuery):
     bot_info = await bot.get_me()
     bot_username = bot_info.username
@@ -1044,9 +1536,7 @@ async def cb_ref_system(call: CallbackQuery):
         "_Нажми на ссылку, чтобы скопировать, и отправь другу!_"
     )
     
-    kb = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="🔙 В меню", callback_data="menu")]
-    ])
+    kb = REF_BACK_KB
     
     try:
         await call.message.edit_text(text, parse_mode="Markdown", reply_markup=kb)
@@ -1056,83 +1546,82 @@ async def cb_ref_system(call: CallbackQuery):
 # -------------------------------------------------
 
 # -- СОЛО --
-@dp.callback_query(lambda c: c.data == "play_solo")
+@dp.callback_query(F.data == "play_solo")
 async def cb_play_solo(call: CallbackQuery):
-    data = await get_player_data(call.from_user.id)
-    kb = [
-        [InlineKeyboardButton(text=f"💰 {b}", callback_data=f"start_solo_{b}") for b in BET_OPTIONS],
-        [InlineKeyboardButton(text="✍️ Своя ставка", callback_data="custom_bet")],
-        [InlineKeyboardButton(text="🔙 В главное меню", callback_data="menu")],
-    ]
+    balance = await get_balance(call.from_user.id)
     text = (
         f"🎮 *Одиночная игра*\n"
         f"━━━━━━━━━━━━━━━\n"
-        f"🪙 Баланс: *{data['balance']}*\n\n"
+        f"🪙 Баланс: *{balance}*\n\n"
         f"Выберите размер ставки:"
     )
-    await call.message.edit_text(text, parse_mode="Markdown", reply_markup=InlineKeyboardMarkup(inline_keyboard=kb))
+    await call.message.edit_text(text, parse_mode="Markdown", reply_markup=SOLO_BET_KB)
 
-@dp.callback_query(lambda c: c.data.startswith("start_solo_"))
+@dp.callback_query(F.data.startswith("start_solo_"))
 async def cb_start_solo(call: CallbackQuery):
-    bet = int(call.data.split("_")[2])
-    data = await get_player_data(call.from_user.id)
-    if data['balance'] < bet: return await call.answer("Мало денег!", show_alert=True)
+    user_id = call.from_user.id
+    bet = int(call.data.rpartition("_")[2])
+    balance = await get_balance(user_id)
+    if balance < bet: return await call.answer("Мало денег!", show_alert=True)
     
-    leave_all_tables(call.from_user.id)
+    leave_all_tables(user_id)
 
-    tid = str(uuid.uuid4())[:8]
-    table = GameTable(tid, is_public=False, owner_id=call.from_user.id)
+    tid = new_table_id()
+    table = GameTable(tid, is_public=False, owner_id=user_id)
     tables[tid] = table
-    p = table.add_player(call.from_user.id, call.from_user.first_name, bet, current_balance=data['balance'])
+    p = table.add_player(user_id, call.from_user.first_name, bet, current_balance=balance)
     
     table.start_game()
-    txt = await render_table_for_player(table, p, bot)
-    kb = get_game_kb(table, p)
-    msg = await call.message.edit_text(txt, reply_markup=kb, parse_mode="Markdown")
-    p.message_id = msg.message_id
+    # Блэкджек на раздаче завершает раунд сразу — считаем его до первой отрисовки
     if table.state == "finished":
         await finalize_game_db(table)
-        await update_table_messages(tid)
+    txt = await render_table_for_player(table, p, bot)
+    kb = get_game_kb(table, p)
+    msg = await call.message.edit_text(txt, reply_markup=kb, parse_mode=TABLE_PARSE_MODE)
+    mark_sent(p, msg, txt, kb)
 
 # -- Кастомная ставка (СОЛО) --
-@dp.callback_query(lambda c: c.data == "custom_bet")
+@dp.callback_query(F.data == "custom_bet")
 async def cb_custom_input(call: CallbackQuery, state: FSMContext):
     await call.message.edit_text("✍️ Введите размер своей ставки (целое число):")
     await state.set_state(BetState.waiting)
 
 @dp.message(BetState.waiting)
 async def process_custom_bet(message: types.Message, state: FSMContext):
-    try:
-        bet = int(message.text)
-        if bet <= 0: raise ValueError
-        data = await get_player_data(message.from_user.id)
-        if data['balance'] < bet:
-            await message.answer("Недостаточно средств!")
-            return
-        
-        leave_all_tables(message.from_user.id)
-        
-        tid = str(uuid.uuid4())[:8]
-        table = GameTable(tid, is_public=False, owner_id=message.from_user.id)
-        tables[tid] = table
-        p = table.add_player(message.from_user.id, message.from_user.first_name, bet, current_balance=data['balance'])
-        
-        table.start_game()
-        txt = await render_table_for_player(table, p, bot)
-        kb = get_game_kb(table, p)
-        msg = await message.answer(txt, reply_markup=kb, parse_mode="Markdown")
-        p.message_id = msg.message_id
-        if table.state == "finished":
-            await finalize_game_db(table)
-            await update_table_messages(tid)
-        await state.clear()
-    except:
+    user_id = message.from_user.id
+    # Проверяем ввод без исключений; длину ограничиваем, чтобы ставка влезла в INTEGER
+    text = (message.text or "").strip()
+    if not text.isdecimal() or len(text) > MAX_BET_DIGITS or int(text) <= 0:
         await message.answer("Ошибка. Введите целое число > 0")
+        return
+    bet = int(text)
+
+    balance = await get_balance(user_id)
+    if balance < bet:
+        await message.answer("Недостаточно средств!")
+        return
+    
+    leave_all_tables(user_id)
+    
+    tid = new_table_id()
+    table = GameTable(tid, is_public=False, owner_id=user_id)
+    tables[tid] = table
+    p = table.add_player(user_id, message.from_user.first_name, bet, current_balance=balance)
+    
+    table.start_game()
+    # Блэкджек на раздаче завершает раунд сразу — считаем его до первой отрисовки
+    if table.state == "finished":
+        await finalize_game_db(table)
+    txt = await render_table_for_player(table, p, bot)
+    kb = get_game_kb(table, p)
+    msg = await message.answer(txt, reply_markup=kb, parse_mode=TABLE_PARSE_MODE)
+    mark_sent(p, msg, txt, kb)
+    await state.clear()
 
 # ЛОГИКА REPLAY СОЛО
-@dp.callback_query(lambda c: c.data.startswith("replay_"))
+@dp.callback_query(F.data.startswith("replay_"))
 async def cb_replay(call: CallbackQuery):
-    tid = call.data.split("_")[1]
+    tid = call.data.rpartition("_")[2]
     table = tables.get(tid)
     
     if not table:
@@ -1142,26 +1631,22 @@ async def cb_replay(call: CallbackQuery):
     leave_all_tables(call.from_user.id, exclude_tid=tid)
     
     p = table.players[0]
+    await wait_settled(table)
     
-    data = await get_player_data(p.user_id)
-    if data['balance'] < p.original_bet: 
+    if await get_balance(p.user_id) < p.original_bet: 
         await call.answer("Недостаточно средств!", show_alert=True)
         return
     
     table.start_game()
-    await update_table_messages(tid)
-    
     if table.state == "finished":
         await finalize_game_db(table)
-        await update_table_messages(tid)
+    schedule_refresh(tid)
 
 # -- МУЛЬТИПЛЕЕР: СПИСОК СТОЛОВ --
-@dp.callback_query(lambda c: c.data == "play_multi" or c.data == "refresh_multi")
+@dp.callback_query(F.data.in_({"play_multi", "refresh_multi"}))
 async def cb_play_multi(call: CallbackQuery):
-    waiting_tables = [t for t in tables.values() if t.is_public and t.state == "waiting"]
-    
     kb = []
-    for t in waiting_tables[:5]: 
+    for t in islice(waiting_tables.values(), 5): 
         owner_name = t.players[0].name if t.players else "Неизвестно"
         players_cnt = len(t.players)
         btn_text = f"👤 {owner_name} | 👥 {players_cnt}/{MAX_PLAYERS}"
@@ -1183,62 +1668,71 @@ async def cb_play_multi(call: CallbackQuery):
     )
     
     if call.data == "refresh_multi":
-         try: await call.message.edit_reply_markup(reply_markup=InlineKeyboardMarkup(inline_keyboard=kb))
+         markup = InlineKeyboardMarkup(inline_keyboard=kb)
+         # Текущая клавиатура приходит вместе с нажатием — если список не изменился,
+         # не ждём от Telegram ошибки «message is not modified»
+         if _kb_signature(call.message.reply_markup) == _kb_signature(markup):
+             return await call.answer("Список актуален")
+         try: await call.message.edit_reply_markup(reply_markup=markup)
          except TelegramBadRequest: await call.answer("Список актуален")
     else:
          await call.message.edit_text(text, parse_mode="Markdown", reply_markup=InlineKeyboardMarkup(inline_keyboard=kb))
 
-@dp.callback_query(lambda c: c.data == "noop")
+@dp.callback_query(F.data == "noop")
 async def cb_noop(call: CallbackQuery):
     await call.answer("В данный момент нет открытых столов. Создайте свой!")
 
 # -- 1. Создание стола --
-@dp.callback_query(lambda c: c.data == "create_table_setup")
+@dp.callback_query(F.data == "create_table_setup")
 async def cb_create_setup(call: CallbackQuery):
-    kb = [
-        [InlineKeyboardButton(text=f"💰 {b}", callback_data=f"new_multi_{b}") for b in BET_OPTIONS],
-        [InlineKeyboardButton(text="✍️ Своя ставка", callback_data="multi_custom_create")],
-        [InlineKeyboardButton(text="🔙 Назад в лобби", callback_data="play_multi")],
-    ]
     text = (
         "🃏 *Создание стола*\n"
         "━━━━━━━━━━━━━━━\n"
         "Выберите базовую ставку для стола:"
     )
-    await call.message.edit_text(text, parse_mode="Markdown", reply_markup=InlineKeyboardMarkup(inline_keyboard=kb))
+    await call.message.edit_text(text, parse_mode="Markdown", reply_markup=CREATE_BET_KB)
 
-@dp.callback_query(lambda c: c.data.startswith("new_multi_"))
+@dp.callback_query(F.data.startswith("new_multi_"))
 async def cb_new_multi_created(call: CallbackQuery):
-    bet = int(call.data.split("_")[2])
+    bet = int(call.data.rpartition("_")[2])
     await create_multi_table(call, bet)
 
-@dp.callback_query(lambda c: c.data == "multi_custom_create")
+@dp.callback_query(F.data == "multi_custom_create")
 async def cb_multi_custom_create_input(call: CallbackQuery, state: FSMContext):
     await call.message.edit_text("✍️ Введите ставку для стола (целое число):")
     await state.set_state(MultiCustomBet.waiting)
     await state.update_data(mode="create")
 
 async def create_multi_table(call: CallbackQuery, bet: int):
-    data = await get_player_data(call.from_user.id)
-    if data['balance'] < bet: return await call.answer("Не хватает денег!", show_alert=True)
+    user_id = call.from_user.id
+    balance = await get_balance(user_id)
+    if balance < bet: return await call.answer("Не хватает денег!", show_alert=True)
     
-    leave_all_tables(call.from_user.id)
+    leave_all_tables(user_id)
     
-    tid = str(uuid.uuid4())[:5]
-    table = GameTable(tid, is_public=True, owner_id=call.from_user.id)
+    tid = new_table_id()
+    table = GameTable(tid, is_public=True, owner_id=user_id)
     tables[tid] = table
     
-    p = table.add_player(call.from_user.id, call.from_user.first_name, bet, current_balance=data['balance'])
+    p = table.add_player(user_id, call.from_user.first_name, bet, current_balance=balance)
     
     txt = render_lobby(table)
     kb = get_lobby_kb(table, p.user_id)
-    msg = await call.message.edit_text(txt, reply_markup=kb, parse_mode="Markdown")
-    p.message_id = msg.message_id
+    msg = await call.message.edit_text(txt, reply_markup=kb, parse_mode=TABLE_PARSE_MODE)
+    mark_sent(p, msg, txt, kb)
 
 # -- 2. Присоединение к столу --
-@dp.callback_query(lambda c: c.data.startswith("prejoin_"))
+@lru_cache(maxsize=1024)
+def get_join_kb(tid):
+    """Выбор ставки при входе за стол: кнопки зависят только от id стола."""
+    kb = [[InlineKeyboardButton(text=f"💰 {b}", callback_data=f"joinbet_{tid}_{b}")] for b in BET_OPTIONS]
+    kb.append([InlineKeyboardButton(text="✍️ Своя ставка", callback_data=f"multi_custom_join_{tid}")])
+    kb.append([InlineKeyboardButton(text="🔙 Отмена", callback_data="play_multi")])
+    return InlineKeyboardMarkup(inline_keyboard=kb)
+
+@dp.callback_query(F.data.startswith("prejoin_"))
 async def cb_prejoin(call: CallbackQuery):
-    tid = call.data.split("_")[1]
+    tid = call.data.rpartition("_")[2]
     table = tables.get(tid)
     if not table or table.state != "waiting":
         return await call.answer("Стол недоступен", show_alert=True)
@@ -1247,20 +1741,18 @@ async def cb_prejoin(call: CallbackQuery):
     if table.get_player(call.from_user.id):
         return await call.answer("Вы уже за этим столом")
 
-    kb = [[InlineKeyboardButton(text=f"💰 {b}", callback_data=f"joinbet_{tid}_{b}")] for b in BET_OPTIONS]
-    kb.append([InlineKeyboardButton(text="✍️ Своя ставка", callback_data=f"multi_custom_join_{tid}")])
-    kb.append([InlineKeyboardButton(text="🔙 Отмена", callback_data="play_multi")])
-    await call.message.edit_text(f"Вы входите за стол #{tid}.\nВаша ставка?", reply_markup=InlineKeyboardMarkup(inline_keyboard=kb))
+    await call.message.edit_text(f"Вы входите за стол #{tid}.\nВаша ставка?", reply_markup=get_join_kb(tid))
 
-@dp.callback_query(lambda c: c.data.startswith("multi_custom_join_"))
+@dp.callback_query(F.data.startswith("multi_custom_join_"))
 async def cb_multi_custom_join_input(call: CallbackQuery, state: FSMContext):
-    tid = call.data.split("_")[3]
+    tid = call.data.rpartition("_")[2]
     await call.message.edit_text(f"✍️ Введите ставку для входа (Стол #{tid}, целое число):")
     await state.set_state(MultiCustomBet.waiting)
     await state.update_data(mode="join", tid=tid)
 
 @dp.message(MultiCustomBet.waiting)
 async def process_multi_custom_bet(message: types.Message, state: FSMContext):
+    user_id = message.from_user.id
     try:
         bet = int(message.text)
         if bet <= 0: raise ValueError
@@ -1268,23 +1760,23 @@ async def process_multi_custom_bet(message: types.Message, state: FSMContext):
         user_data = await state.get_data()
         mode = user_data.get("mode")
         
-        p_data = await get_player_data(message.from_user.id)
-        if p_data['balance'] < bet:
+        balance = await get_balance(user_id)
+        if balance < bet:
             await message.answer("Недостаточно средств!")
             return
             
         if mode == "create":
-            leave_all_tables(message.from_user.id) 
+            leave_all_tables(user_id) 
             
-            tid = str(uuid.uuid4())[:5]
-            table = GameTable(tid, is_public=True, owner_id=message.from_user.id)
+            tid = new_table_id()
+            table = GameTable(tid, is_public=True, owner_id=user_id)
             tables[tid] = table
-            p = table.add_player(message.from_user.id, message.from_user.first_name, bet, current_balance=p_data['balance'])
+            p = table.add_player(user_id, message.from_user.first_name, bet, current_balance=balance)
             
             txt = render_lobby(table)
             kb = get_lobby_kb(table, p.user_id)
-            msg = await message.answer(txt, reply_markup=kb, parse_mode="Markdown")
-            p.message_id = msg.message_id
+            msg = await message.answer(txt, reply_markup=kb, parse_mode=TABLE_PARSE_MODE)
+            mark_sent(p, msg, txt, kb)
             
         elif mode == "join":
             tid = user_data.get("tid")
@@ -1309,48 +1801,48 @@ async def join_multi_table(msg_obj, tid, bet):
 
     leave_all_tables(msg_obj.from_user.id)
     
-    data = await get_player_data(msg_obj.from_user.id)
-    p = table.add_player(msg_obj.from_user.id, msg_obj.from_user.first_name, bet, current_balance=data['balance'])
+    balance = await get_balance(msg_obj.from_user.id)
+    p = table.add_player(msg_obj.from_user.id, msg_obj.from_user.first_name, bet, current_balance=balance)
     
     txt = render_lobby(table)
     kb = get_lobby_kb(table, p.user_id)
-    sent_msg = await msg_obj.answer(txt, reply_markup=kb, parse_mode="Markdown")
-    p.message_id = sent_msg.message_id
+    sent_msg = await msg_obj.answer(txt, reply_markup=kb, parse_mode=TABLE_PARSE_MODE)
+    mark_sent(p, sent_msg, txt, kb)
     
-    await update_table_messages(tid)
+    schedule_refresh(tid)
 
-@dp.callback_query(lambda c: c.data.startswith("joinbet_"))
+@dp.callback_query(F.data.startswith("joinbet_"))
 async def cb_join_confirm(call: CallbackQuery):
-    parts = call.data.split("_") 
-    tid = parts[1]
-    bet = int(parts[2])
+    user_id = call.from_user.id
+    _, tid, bet = call.data.rsplit("_", 2)
+    bet = int(bet)
     
     table = tables.get(tid)
     if not table or table.state != "waiting":
-         return await call.message.edit_text("Стол исчез или игра началась.", reply_markup=InlineKeyboardMarkup(inline_keyboard=[[InlineKeyboardButton(text="Ок", callback_data="play_multi")]]))
+         return await call.message.edit_text("Стол исчез или игра началась.", reply_markup=TABLE_GONE_KB)
     
-    if table.get_player(call.from_user.id):
+    if table.get_player(user_id):
         return await call.answer("Вы уже здесь!")
     
-    data = await get_player_data(call.from_user.id)
-    if data['balance'] < bet:
+    balance = await get_balance(user_id)
+    if balance < bet:
         return await call.answer("Не хватает денег!", show_alert=True)
 
-    leave_all_tables(call.from_user.id)
+    leave_all_tables(user_id)
 
-    p = table.add_player(call.from_user.id, call.from_user.first_name, bet, current_balance=data['balance'])
+    p = table.add_player(user_id, call.from_user.first_name, bet, current_balance=balance)
     
     txt = render_lobby(table)
     kb = get_lobby_kb(table, p.user_id)
-    msg = await call.message.edit_text(txt, reply_markup=kb, parse_mode="Markdown")
-    p.message_id = msg.message_id
+    msg = await call.message.edit_text(txt, reply_markup=kb, parse_mode=TABLE_PARSE_MODE)
+    mark_sent(p, msg, txt, kb)
     
-    await update_table_messages(tid)
+    schedule_refresh(tid)
 
 # -- ГОТОВНОСТЬ (READY) --
-@dp.callback_query(lambda c: c.data.startswith("ready_"))
+@dp.callback_query(F.data.startswith("ready_"))
 async def cb_ready(call: CallbackQuery):
-    tid = call.data.split("_")[1]
+    tid = call.data.rpartition("_")[2]
     table = tables.get(tid)
     if not table: return await call.answer("Стол не найден")
     
@@ -1362,40 +1854,41 @@ async def cb_ready(call: CallbackQuery):
     
     if table.check_all_ready():
         table.start_game()
-        await update_table_messages(tid)
+        # Раунд, закончившийся на раздаче, рисуем один раз — уже с итогами
         if table.state == "finished":
             await finalize_game_db(table)
-            await update_table_messages(tid)
+        schedule_refresh(tid)
     else:
-        await update_table_messages(tid)
+        schedule_refresh(tid)
 
 # -- РЕВАНШ / СМЕНА СТАВКИ --
-@dp.callback_query(lambda c: c.data.startswith("rematch_") or c.data.startswith("chbet_lobby_"))
+@lru_cache(maxsize=1024)
+def get_rebet_kb(tid, original_bet):
+    """Меню ставки на следующий раунд: зависит только от стола и текущей ставки."""
+    return InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text=f"Оставить: {original_bet}", callback_data=f"m_rebet_{tid}_{original_bet}")],
+        [InlineKeyboardButton(text=f"{b}", callback_data=f"m_rebet_{tid}_{b}") for b in BET_OPTIONS],
+        [InlineKeyboardButton(text="✍️ Своя ставка", callback_data=f"multi_custom_rebet_{tid}")],
+        [InlineKeyboardButton(text="🔙 Отмена (Выйти)", callback_data=f"leave_lobby_{tid}")],
+    ])
+
+@dp.callback_query(F.data.startswith(("rematch_", "chbet_lobby_")))
 async def cb_rematch_or_change(call: CallbackQuery):
-    parts = call.data.split("_")
-    tid = parts[-1] 
+    tid = call.data.rpartition("_")[2]
     
     table = tables.get(tid)
     if not table: return await cb_play_multi(call)
     
     p = table.get_player(call.from_user.id)
     if not p: return await cb_play_multi(call)
+    # Сообщение стола сейчас станет меню ставок — следующую перерисовку не пропускаем
+    p.last_sent = None
     
-    kb = []
-    kb.append([InlineKeyboardButton(text=f"Оставить: {p.original_bet}", callback_data=f"m_rebet_{tid}_{p.original_bet}")])
-    row = []
-    for b in BET_OPTIONS:
-         row.append(InlineKeyboardButton(text=f"{b}", callback_data=f"m_rebet_{tid}_{b}"))
-    kb.append(row)
-    
-    kb.append([InlineKeyboardButton(text="✍️ Своя ставка", callback_data=f"multi_custom_rebet_{tid}")])
-    kb.append([InlineKeyboardButton(text="🔙 Отмена (Выйти)", callback_data=f"leave_lobby_{tid}")])
-    
-    await call.message.edit_text(f"💰 Ставка на следующий раунд?\n(Текущая: {p.original_bet})", reply_markup=InlineKeyboardMarkup(inline_keyboard=kb))
+    await call.message.edit_text(f"💰 Ставка на следующий раунд?\n(Текущая: {p.original_bet})", reply_markup=get_rebet_kb(tid, p.original_bet))
 
-@dp.callback_query(lambda c: c.data.startswith("multi_custom_rebet_"))
+@dp.callback_query(F.data.startswith("multi_custom_rebet_"))
 async def cb_multi_custom_rebet_input(call: CallbackQuery, state: FSMContext):
-    tid = call.data.split("_")[3]
+    tid = call.data.rpartition("_")[2]
     await call.message.edit_text(f"✍️ Введите новую ставку (Стол #{tid}, целое число):")
     await state.set_state(MultiCustomBet.waiting)
     await state.update_data(mode="rebet", tid=tid)
@@ -1408,6 +1901,7 @@ async def rebet_multi_table(message, tid, bet):
     
     p = table.get_player(message.from_user.id)
     if not p: return 
+    await wait_settled(table)
     
     p.original_bet = bet
     p.bet = bet
@@ -1418,25 +1912,24 @@ async def rebet_multi_table(message, tid, bet):
         
     txt = render_lobby(table)
     kb = get_lobby_kb(table, p.user_id)
-    sent_msg = await message.answer(txt, reply_markup=kb, parse_mode="Markdown")
-    p.message_id = sent_msg.message_id
+    sent_msg = await message.answer(txt, reply_markup=kb, parse_mode=TABLE_PARSE_MODE)
+    mark_sent(p, sent_msg, txt, kb)
     
-    await update_table_messages(tid)
+    schedule_refresh(tid)
 
-@dp.callback_query(lambda c: c.data.startswith("m_rebet_"))
+@dp.callback_query(F.data.startswith("m_rebet_"))
 async def cb_multi_rebet(call: CallbackQuery):
-    parts = call.data.split("_")
-    tid = parts[2]
-    bet = int(parts[3])
+    _, tid, bet = call.data.rsplit("_", 2)
+    bet = int(bet)
     
     table = tables.get(tid)
     if not table: return await cb_play_multi(call)
     
     p = table.get_player(call.from_user.id)
     if not p: return 
+    await wait_settled(table)
     
-    data = await get_player_data(p.user_id)
-    if data['balance'] < bet:
+    if await get_balance(p.user_id) < bet:
         return await call.answer("Не хватает денег!", show_alert=True)
     
     # Обновляем ставку
@@ -1449,42 +1942,48 @@ async def cb_multi_rebet(call: CallbackQuery):
         
     txt = render_lobby(table)
     kb = get_lobby_kb(table, p.user_id)
-    try:
-        await bot.edit_message_text(txt, chat_id=p.user_id, message_id=p.message_id, reply_markup=kb, parse_mode="Markdown")
-    except: pass
+    await _edit_player_messages([(p, txt, kb)])
     
-    await update_table_messages(tid)
+    schedule_refresh(tid)
 
 
-@dp.callback_query(lambda c: c.data.startswith("leave_lobby_"))
+@dp.callback_query(F.data.startswith("leave_lobby_"))
 async def cb_leave_lobby(call: CallbackQuery):
-    tid = call.data.split("_")[2]
+    tid = call.data.rpartition("_")[2]
     table = tables.get(tid)
     if table:
         table.remove_player(call.from_user.id)
-        await update_table_messages(tid)
+        # Пустой стол убираем сразу, иначе он успеет попасть в список лобби
+        if table.players:
+            schedule_refresh(tid)
+        else:
+            drop_table(tid)
     await cb_play_multi(call) 
 
-@dp.callback_query(lambda c: c.data.startswith("close_lobby_"))
+@dp.callback_query(F.data.startswith("close_lobby_"))
 async def cb_close_lobby(call: CallbackQuery):
-    tid = call.data.split("_")[2]
+    tid = call.data.rpartition("_")[2]
     table = tables.get(tid)
-    if table:
-        for p in table.players:
-            if p.user_id != table.owner_id: 
-                 try: await bot.send_message(p.user_id, "Стол был закрыт владельцем.")
-                 except: pass
-        del tables[tid]
+    if not table:
+        return await cb_play_multi(call)
+    # Уведомления уходят параллельно с ответом владельцу, а не перед ним
+    notices = asyncio.gather(
+        *[
+            bot.send_message(p.user_id, "Стол был закрыт владельцем.")
+            for p in table.players if p.user_id != table.owner_id
+        ],
+        return_exceptions=True,
+    )
+    drop_table(tid)
     await cb_play_multi(call)
+    await notices
 
-# -- GAME ACTIONS --
-@dp.callback_query(lambda c: c.data.startswith("hit_"))
-async def cb_hit(call: CallbackQuery):
-    tid = call.data.split("_")[1]
+# -- GAME ACTIONS (вызываются через cb_game_action) --
+async def cb_hit(call: CallbackQuery, tid: str):
     table = tables.get(tid)
     if not table: return await call.answer("Ошибка")
     player = table.get_player(call.from_user.id)
-    if not player or table.players[table.current_player_index] != player:
+    if not player or table.current_player is not player:
         return await call.answer("Не твой ход!")
 
     c, s = table.deck.get_card()
@@ -1497,31 +1996,20 @@ async def cb_hit(call: CallbackQuery):
         player.status = "bust"
         await call.answer("Перебор!", show_alert=False)
         # Переходим к следующей активной руке или игроку
-        next_idx = player.first_active_hand_index()
-        if next_idx is not None:
-            player.current_hand_index = next_idx
-        else:
-            table.process_turns()
+        advance_turn(table, player)
     elif player.value == 21:
         player.status = "stand"
         await call.answer("21! Стоп.", show_alert=False)
-        # Переходим к следующей активной руке или игроку
-        next_idx = player.first_active_hand_index()
-        if next_idx is not None:
-            player.current_hand_index = next_idx
-        else:
-            table.process_turns()
-        
-    if table.state == "finished": await finalize_game_db(table)
-    await update_table_messages(tid)
+        advance_turn(table, player)
+    else:
+        await call.answer()
+        schedule_refresh(tid)
 
-@dp.callback_query(lambda c: c.data.startswith("stand_"))
-async def cb_stand(call: CallbackQuery):
-    tid = call.data.split("_")[1]
+async def cb_stand(call: CallbackQuery, tid: str):
     table = tables.get(tid)
     if not table: return
     player = table.get_player(call.from_user.id)
-    if not player or table.players[table.current_player_index] != player:
+    if not player or table.current_player is not player:
         return await call.answer("Не твой ход!")
 
     player.status = "stand"
@@ -1530,25 +2018,16 @@ async def cb_stand(call: CallbackQuery):
 
     # Если есть ещё активные руки у этого же игрока — переходим к ним,
     # иначе передаём ход следующему игроку
-    next_idx = player.first_active_hand_index()
-    if next_idx is not None:
-        player.current_hand_index = next_idx
-    else:
-        table.process_turns()
-    if table.state == "finished": await finalize_game_db(table)
-    await update_table_messages(tid)
+    advance_turn(table, player)
 
-@dp.callback_query(lambda c: c.data.startswith("double_"))
-async def cb_double(call: CallbackQuery):
-    tid = call.data.split("_")[1]
+async def cb_double(call: CallbackQuery, tid: str):
     table = tables.get(tid)
     if not table: return
     player = table.get_player(call.from_user.id)
-    if not player or table.players[table.current_player_index] != player:
+    if not player or table.current_player is not player:
         return await call.answer("Не твой ход!")
 
-    data = await get_player_data(player.user_id)
-    if data['balance'] < player.bet * 2: return await call.answer("Не хватает фишек!", show_alert=True)
+    if await get_balance(player.user_id) < player.bet * 2: return await call.answer("Не хватает фишек!", show_alert=True)
     
     player.bet *= 2
     c, s = table.deck.get_card()
@@ -1563,23 +2042,15 @@ async def cb_double(call: CallbackQuery):
     await call.answer("Удвоение!")
 
     # После double ход по этой руке заканчивается — переходим дальше
-    next_idx = player.first_active_hand_index()
-    if next_idx is not None:
-        player.current_hand_index = next_idx
-    else:
-        table.process_turns()
-    if table.state == "finished": await finalize_game_db(table)
-    await update_table_messages(tid)
+    advance_turn(table, player)
 
-@dp.callback_query(lambda c: c.data.startswith("split_"))
-async def cb_split(call: CallbackQuery):
-    tid = call.data.split("_")[1]
+async def cb_split(call: CallbackQuery, tid: str):
     table = tables.get(tid)
     if not table:
         return
 
     player = table.get_player(call.from_user.id)
-    if not player or table.players[table.current_player_index] != player:
+    if not player or table.current_player is not player:
         return await call.answer("Не твой ход!")
 
     # Сплит возможен только если одна рука и две подходящие карты (см. can_split_cards)
@@ -1591,8 +2062,7 @@ async def cb_split(call: CallbackQuery):
         return await call.answer("Сейчас нельзя делать сплит.", show_alert=True)
 
     # Проверяем, хватает ли баланса на вторую ставку
-    data = await get_player_data(player.user_id)
-    if data["balance"] < player.bet * 2:
+    if await get_balance(player.user_id) < player.bet * 2:
         return await call.answer("Не хватает фишек для сплита!", show_alert=True)
 
     # Разделяем карты на две руки
@@ -1612,18 +2082,24 @@ async def cb_split(call: CallbackQuery):
     player.hand.append(c)
 
     await call.answer("Руки разделены! Играем первую руку.")
-    await update_table_messages(tid)
+    schedule_refresh(tid)
+
+GAME_ACTIONS = {
+    "hit": cb_hit,
+    "stand": cb_stand,
+    "double": cb_double,
+    "split": cb_split,
+}
 
 # -- СТАТИСТИКА (С РЕФЕРАЛАМИ) --
-@dp.callback_query(lambda c: c.data == "stats")
+@dp.callback_query(F.data == "stats")
 async def cb_stats(call: CallbackQuery):
-    data = await get_player_data(call.from_user.id)
+    user_id = call.from_user.id
+    data = await get_player_data(user_id)
     s = data['stats']
     
     # Считаем количество рефералов
-    refs_count = 0
-    async with pool.acquire() as conn:
-        refs_count = await conn.fetchval("SELECT COUNT(*) FROM users WHERE referrer_id = $1", call.from_user.id)
+    refs_count = await pool.fetchval("SELECT COUNT(*) FROM users WHERE referrer_id = $1", user_id)
 
     total_games = s['games']
     win_rate = round((s['wins'] / total_games * 100), 1) if total_games > 0 else 0
@@ -1646,61 +2122,42 @@ async def cb_stats(call: CallbackQuery):
         f"🏦 Макс. баланс: *{s['max_balance']}*\n"
         f"🤑 Макс. выигрыш: *{s['max_win']}*\n\n"
         
-        f"🆔 ID: `{call.from_user.id}`"
+        f"🆔 ID: `{user_id}`"
     )
     
     await call.message.edit_text(
         stats_text, 
         parse_mode="Markdown", 
-        reply_markup=InlineKeyboardMarkup(inline_keyboard=[[InlineKeyboardButton(text="🔙 Меню", callback_data="menu")]])
+        reply_markup=STATS_BACK_KB
     )
 
-# -- БЕСПЛАТНЫЕ ФИШКИ (ВЕРСИЯ: РАБОТАЕМ С ТЕКСТОМ) --
-@dp.callback_query(lambda c: c.data == "free_chips")
+# -- БЕСПЛАТНЫЕ ФИШКИ (РАЗ В ДЕНЬ, СБРОС В 06:00 UTC) --
+@dp.callback_query(F.data == "free_chips")
 async def cb_free_chips(call: CallbackQuery):
     try:
         user_id = call.from_user.id
         now_utc = datetime.now(timezone.utc)
         
-        # 1. Формируем сегодняшнюю дату как простую строку "2026-02-08"
+        # 1. Бонусный день начинается в 06:00 UTC
         current_bonus_date = (now_utc - timedelta(hours=6)).date()
-        target_date_str = str(current_bonus_date)
-        
-        async with pool.acquire() as conn:
-            # 2. Получаем данные. Используем ::TEXT, чтобы база отдала нам строку в любом случае
-            try:
-                row = await conn.fetchrow("SELECT last_bonus_date::TEXT FROM users WHERE user_id = $1", user_id)
-            except Exception:
-                # Если колонки нет - создаем (по умолчанию создаем как DATE, но работать будет и с TEXT)
-                await conn.execute("ALTER TABLE users ADD COLUMN IF NOT EXISTS last_bonus_date DATE")
-                row = await conn.fetchrow("SELECT last_bonus_date::TEXT FROM users WHERE user_id = $1", user_id)
-
-            # Получаем строку из базы. Если там None, будет None.
-            # Если там дата 2026-02-08, придет строка "2026-02-08"
-            db_date_str = row['last_bonus_date'] if row else None
-            
-            # Если строка длинная (например с временем "2026-02-08 12:00:00"), обрезаем до 10 символов
-            if db_date_str and len(str(db_date_str)) > 10:
-                db_date_str = str(db_date_str)[:10]
-
-            # 3. СРАВНИВАЕМ (Строка со строкой)
-            if str(db_date_str) == target_date_str:
-                next_reset = datetime.combine(current_bonus_date + timedelta(days=1), dt_time(6, 0), tzinfo=timezone.utc)
-                delta = next_reset - now_utc
-                hours = int(delta.total_seconds() // 3600)
-                minutes = int((delta.total_seconds() % 3600) // 60)
-                
-                await call.answer(f"⏳ Вы уже получили бонус сегодня!\nПриходите через: {hours}ч {minutes}мин", show_alert=True)
-                return
 
-            # 4. НАЧИСЛЯЕМ
-            # Записываем дату. Используем safe-cast ::DATE, он работает и для текстовых колонок, и для дат.
-            await conn.execute(f"UPDATE users SET balance = balance + 1000, last_bonus_date = '{target_date_str}'::date WHERE user_id = $1", user_id)
+        # 2. Проверка и начисление — один запрос: строка обновится,
+        # только если last_bonus_date ещё не сегодняшний (и двойной клик не даст два бонуса)
+        new_bal = await pool.fetchval(SQL_CLAIM_DAILY_BONUS, user_id, current_bonus_date, DAILY_BONUS)
+
+        if new_bal is None:
+            next_reset = datetime.combine(current_bonus_date + timedelta(days=1), dt_time(6, 0), tzinfo=timezone.utc)
+            delta = next_reset - now_utc
+            hours = int(delta.total_seconds() // 3600)
+            minutes = int((delta.total_seconds() % 3600) // 60)
             
-            new_bal = await conn.fetchval("SELECT balance FROM users WHERE user_id = $1", user_id)
+            await call.answer(f"⏳ Вы уже получили бонус сегодня!\nПриходите через: {hours}ч {minutes}мин", show_alert=True)
+            return
 
-        # 5. УСПЕХ
-        await call.answer(f"🎁 ЕЖЕДНЕВНЫЙ БОНУС!\n\n+1000 фишек начислено.\nБаланс: {new_bal} 🪙", show_alert=True)
+        balance_cache[user_id] = new_bal
+
+        # 3. УСПЕХ
+        await call.answer(f"🎁 ЕЖЕДНЕВНЫЙ БОНУС!\n\n+{DAILY_BONUS} фишек начислено.\nБаланс: {new_bal} 🪙", show_alert=True)
         
         try: await cb_menu(call)
         except: pass
@@ -1721,37 +2178,37 @@ async def process_table_chat(message: types.Message, state: FSMContext):
         pass 
 
     user_id = message.from_user.id
-    target_table = None
-    
-    for table in tables.values():
-        if table.get_player(user_id):
-            target_table = table
-            break
+    tid = user_to_table.get(user_id)
+    target_table = tables.get(tid) if tid else None
             
     # <-- ОБРАТИ ВНИМАНИЕ: этот if должен быть не внутри цикла for, а после него
     if target_table:
         # <-- ВОТ ЗДЕСЬ БЫЛА ОШИБКА. Добавлен отступ (4 пробела)
         target_table.add_chat_message(message.from_user.first_name, message.text)
-        await update_table_messages(target_table.id)
+        schedule_refresh(target_table.id)
         # ЛОГИРУЕМ ЧАТ
-        await log_chat(target_table.id, user_id, message.from_user.username, message.text)
+        log_chat(target_table.id, user_id, message.from_user.username, message.text)
 
 # --- ВСТАВЛЯТЬ ОТСЮДА (Без отступов!) ---
 
 @dp.message(Command("fixdb"))
 async def cmd_manual_fix(message: types.Message):
-    async with pool.acquire() as conn:
-        try:
-            await conn.execute("ALTER TABLE users ADD COLUMN IF NOT EXISTS last_bonus_date DATE")
-            await message.answer("✅ База данных успешно обновлена! Пробуй брать фишки.")
-        except Exception as e:
-            await message.answer(f"❌ Ошибка: {e}")
+    try:
+        await pool.execute("ALTER TABLE users ADD COLUMN IF NOT EXISTS last_bonus_date DATE")
+        await message.answer("✅ База данных успешно обновлена! Пробуй брать фишки.")
+    except Exception as e:
+        await message.answer(f"❌ Ошибка: {e}")
 
 async def main():
     await init_db()
+    writer = asyncio.create_task(chat_log_writer())
     print("Bot started")
-    asyncio.create_task(check_timeouts_loop()) # Запуск фоновой проверки таймаутов
-    await dp.start_polling(bot)
+    try:
+        await dp.start_polling(bot)
+    finally:
+        writer.cancel()
+        await asyncio.gather(writer, return_exceptions=True)
+        await drain_chat_logs()
 
 if __name__ == "__main__":
     asyncio.run(main())